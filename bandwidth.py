@@ -0,0 +1,127 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+        Rate limit in bytes per second, 0 for unlimited. Tokens accumulate up to one second worth of rate.
+        A transfer may take more tokens than the bucket holds (e.g. a 16 KiB block under a 10 KiB/s limit):
+        the bucket goes negative and the next transfers wait for it to refill.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def is_limited(self):
+        return self.rate > 0
+
+    def can_consume(self, nbytes):
+        if not self.is_limited():
+            return True
+
+        with self.lock:
+            self._refill()
+            return self.tokens >= min(nbytes, self.rate)
+
+    def consume(self, nbytes):
+        if not self.is_limited():
+            return
+
+        with self.lock:
+            self._refill()
+            self.tokens -= nbytes
+
+    def delay(self, nbytes):
+        """
+            Seconds before nbytes can be consumed
+        """
+        if not self.is_limited():
+            return 0.0
+
+        with self.lock:
+            self._refill()
+            return max(0.0, (min(nbytes, self.rate) - self.tokens) / self.rate)
+
+    def allowance(self, unit):
+        """
+            How many transfers of unit bytes can start now
+        """
+        if not self.is_limited():
+            return None
+
+        with self.lock:
+            self._refill()
+            if self.tokens < min(unit, self.rate):
+                return 0
+            return max(1, int(self.tokens // unit))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+
+class BandwidthLimits(object):
+    """
+        Upload and download limits of one level: the whole client, a torrent or a peer.
+        Can be changed at any time, 0 removes a limit.
+    """
+
+    def __init__(self, upload_rate=0, download_rate=0):
+        self.upload = TokenBucket(upload_rate)
+        self.download = TokenBucket(download_rate)
+
+    def set_limits(self, upload_rate=None, download_rate=None):
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
+
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+
+
+# Shared by every torrent
+global_limits = BandwidthLimits()
+
+
+def is_limited(buckets):
+    return any(bucket.is_limited() for bucket in buckets)
+
+
+def try_consume(buckets, nbytes):
+    """
+        Takes nbytes from every bucket if they all allow it
+    """
+    if not all(bucket.can_consume(nbytes) for bucket in buckets):
+        return False
+
+    for bucket in buckets:
+        bucket.consume(nbytes)
+
+    return True
+
+
+def consume(buckets, nbytes):
+    for bucket in buckets:
+        bucket.consume(nbytes)
+
+
+def delay(buckets, nbytes):
+    return max(bucket.delay(nbytes) for bucket in buckets)
+
+
+def allowance(buckets, unit):
+    """
+        How many transfers of unit bytes every bucket allows now, None if none of them is limited
+    """
+    allowances = [a for a in (bucket.allowance(unit) for bucket in buckets) if a is not None]
+
+    return min(allowances) if allowances else None
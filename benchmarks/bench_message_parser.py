@@ -0,0 +1,120 @@
+"""
+    Microbenchmark of the receive path: the streaming MessageParser against the previous
+    bytes-buffer framing + MessageDispatcher (reproduced below as legacy_messages).
+
+    The legacy framing re-slices its whole bytes buffer after every message, so its cost grows with the
+    amount of data handed over per read; both 64 KiB reads and 1 MiB reads (the old select loop
+    drained the socket until EAGAIN) are measured.
+
+    Usage: python benchmarks/bench_message_parser.py
+"""
+import os
+import sys
+import time
+from struct import unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import message
+from block import BLOCK_SIZE
+
+CHUNK_SIZES = (64 * 1024, 1024 * 1024)
+
+
+def legacy_dispatch(payload):
+    payload_length, message_id, = unpack(">IB", payload[:5])
+
+    map_id_to_message = {
+        0: message.Choke,
+        1: message.UnChoke,
+        2: message.Interested,
+        3: message.NotInterested,
+        4: message.Have,
+        5: message.BitField,
+        6: message.Request,
+        7: message.Piece,
+        8: message.Cancel,
+        9: message.Port
+    }
+
+    if message_id not in list(map_id_to_message.keys()):
+        raise message.WrongMessageException("Wrong message id")
+
+    if message_id == message.Piece.message_id:
+        block_length = len(payload) - 13
+        _, _, piece_index, block_offset, block = unpack(">IBII{}s".format(block_length), payload[:13 + block_length])
+        return message.Piece(block_length, piece_index, block_offset, block)
+
+    if message_id == message.Have.message_id:
+        _, _, piece_index = unpack(">IBI", payload[:9])
+        return message.Have(piece_index)
+
+    _, _, piece_index, block_offset, block_length = unpack(">IBIII", payload[:17])
+    return message.Request(piece_index, block_offset, block_length)
+
+
+def legacy_messages(chunks):
+    read_buffer = b''
+
+    for chunk in chunks:
+        read_buffer += chunk
+
+        while len(read_buffer) > 4:
+            payload_length, = unpack(">I", read_buffer[:4])
+            total_length = payload_length + 4
+
+            if len(read_buffer) < total_length:
+                break
+
+            payload = read_buffer[:total_length]
+            read_buffer = read_buffer[total_length:]
+            yield legacy_dispatch(payload)
+
+
+def parser_messages(chunks):
+    parser = message.MessageParser()
+    parser.has_handshaked = True
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+        for new_message in parser.messages():
+            yield new_message
+
+
+def make_stream(kind, count, chunk_size):
+    block = os.urandom(BLOCK_SIZE)
+    messages = []
+
+    for i in range(count):
+        if kind == 'piece':
+            messages.append(message.Piece(BLOCK_SIZE, i, 0, block).to_bytes())
+        else:
+            messages.append(message.Have(i).to_bytes())
+            messages.append(message.Request(i, 0, BLOCK_SIZE).to_bytes())
+
+    stream = b''.join(messages)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+    return chunks, len(messages)
+
+
+def bench(name, messages_generator, chunks, expected):
+    start = time.perf_counter()
+    received = sum(1 for _ in messages_generator(chunks))
+    elapsed = time.perf_counter() - start
+
+    assert received == expected, (received, expected)
+    print("{:<8} {:>8} msgs  {:8.3f} s  {:8.2f} us/msg".format(name, received, elapsed, elapsed / received * 1e6))
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    for chunk_size in CHUNK_SIZES:
+        for kind, count in (('piece', 20000), ('small', 100000)):
+            chunks, expected = make_stream(kind, count, chunk_size)
+            print("-- %s messages, %d byte reads" % (kind, chunk_size))
+            legacy = bench('legacy', legacy_messages, chunks, expected)
+            parser = bench('parser', parser_messages, chunks, expected)
+            print("speedup x%.1f" % (legacy / parser))
@@ -1,20 +1,50 @@
-from enum import Enum
+import math
+import time
+from array import array
+from enum import IntEnum
 
 BLOCK_SIZE = 2 ** 14
+BLOCK_REQUEST_TIMEOUT = 5
 
 
-class State(Enum):
+class State(IntEnum):
     FREE = 0
     PENDING = 1
     FULL = 2
 
 
-class Block():
-    def __init__(self, state: State = State.FREE, block_size: int = BLOCK_SIZE, data: bytes = b'', last_seen: float = 0):
-        self.state: State = state
-        self.block_size: int = block_size
-        self.data: bytes = data
-        self.last_seen: float = last_seen
+class BlockStates(object):
+    """
+        State and last request time of every block of a torrent, indexed by global block number
+        (piece_index * blocks_per_piece + block index in the piece).
 
-    def __str__(self):
-        return "%s - %d - %d - %d" % (self.state, self.block_size, len(self.data), self.last_seen)
\ No newline at end of file
+        One byte of state and a 4 byte timestamp per block instead of one object per block. Timestamps
+        are float32 seconds since self.epoch, precise enough for request timeouts.
+    """
+
+    def __init__(self, number_of_pieces, piece_length, total_length):
+        self.blocks_per_piece = int(math.ceil(float(piece_length) / BLOCK_SIZE))
+        self.number_of_blocks = number_of_pieces * self.blocks_per_piece
+        self.states = bytearray(self.number_of_blocks)  # all State.FREE
+        self.last_seen = array('f', bytes(4 * self.number_of_blocks))
+        self.epoch = time.time()
+
+        # The last piece can have fewer blocks: its unused slots are never requested
+        last_piece_size = total_length - (number_of_pieces - 1) * piece_length
+        unused_blocks = self.blocks_per_piece - int(math.ceil(float(last_piece_size) / BLOCK_SIZE))
+        self.states[self.number_of_blocks - unused_blocks:] = bytes([State.FULL]) * unused_blocks
+
+    def now(self):
+        return time.time() - self.epoch
+
+    def first_block(self, piece_index):
+        return piece_index * self.blocks_per_piece
+
+    def release(self, piece_index, block_offset):  # request dropped (choke, disconnect) : set it free
+        index = self.first_block(piece_index) + block_offset // BLOCK_SIZE
+
+        if self.states[index] == State.PENDING:
+            self.states[index] = State.FREE
+
+    def has_free_blocks(self):
+        return State.FREE in self.states
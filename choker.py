@@ -0,0 +1,53 @@
+import random
+import logging
+
+UNCHOKE_SLOTS = 4  # peers unchoked for their transfer rate, plus one optimistic unchoke
+CHOKE_INTERVAL = 10
+OPTIMISTIC_UNCHOKE_INTERVAL = 30
+
+
+class Choker(object):
+    """
+        Tit-for-tat choking. Every CHOKE_INTERVAL seconds the UNCHOKE_SLOTS interested peers we download
+        the fastest from (we upload the fastest to when seeding) are unchoked, plus one optimistic unchoke,
+        rotated every OPTIMISTIC_UNCHOKE_INTERVAL seconds to a random choked interested peer so that new
+        peers get a chance to show their rate. Everybody else is choked.
+    """
+
+    def __init__(self, peers_manager):
+        self.peers_manager = peers_manager
+        self.optimistic_peer = None
+        self.rounds = 0
+
+    def peer_interested(self, peer):
+        # No need to wait for the next round while a slot is free
+        unchoked_peers = sum(1 for p in self.peers_manager.peers if p.am_unchoking())
+
+        if unchoked_peers < UNCHOKE_SLOTS + 1:
+            peer.set_choking(False)
+
+    def run_round(self):
+        peers = self.peers_manager.peers
+        seeding = self.peers_manager.pieces_manager.all_pieces_completed()
+        rates = {peer: peer.upload_meter.rate() if seeding else peer.download_meter.rate() for peer in peers}
+
+        interested_peers = [peer for peer in peers if peer.is_interested()]
+        interested_peers.sort(key=lambda peer: rates[peer], reverse=True)
+        unchoked_peers = set(interested_peers[:UNCHOKE_SLOTS])
+
+        # a new optimistic peer is also picked when the current one became one of the fastest
+        rounds_per_optimistic_unchoke = OPTIMISTIC_UNCHOKE_INTERVAL // CHOKE_INTERVAL
+        if self.rounds % rounds_per_optimistic_unchoke == 0 or self.optimistic_peer not in interested_peers \
+                or self.optimistic_peer in unchoked_peers:
+            candidates = [peer for peer in interested_peers if peer not in unchoked_peers]
+            self.optimistic_peer = random.choice(candidates) if candidates else None
+
+        if self.optimistic_peer is not None:
+            unchoked_peers.add(self.optimistic_peer)
+
+        for peer in peers:
+            peer.set_choking(peer not in unchoked_peers)
+
+        self.rounds += 1
+        logging.debug("Choke round: %d unchoked peer(s) of %d interested" % (len(unchoked_peers),
+                                                                           len(interested_peers)))
@@ -0,0 +1,122 @@
+import os
+import queue
+import logging
+from collections import OrderedDict
+from threading import Thread
+
+MAX_OPEN_FILES = 64
+MAX_BATCH_JOBS = 256
+IOV_MAX = 1024
+
+
+class DiskWriter(Thread):
+    """
+        Writes verified pieces to disk in a background thread.
+
+        Queued jobs of file segments (path, file offset, buffer) are drained in batches, sorted, and
+        adjacent segments of the same file (e.g. consecutive pieces) are written with a single pwritev.
+        Open file descriptors are kept in an LRU cache instead of being reopened for every piece.
+    """
+
+    def __init__(self, max_open_files=MAX_OPEN_FILES):
+        Thread.__init__(self, name='DiskWriter')
+        self.queue = queue.Queue()
+        self.max_open_files = max_open_files
+        self.file_descriptors = OrderedDict()
+        self.is_active = True
+
+    def write(self, segments, callback=None):
+        """
+            :param segments: iterable of (path, file_offset, buffer), buffers must not change until written
+            :param callback: called without arguments from the writer thread once the segments are written
+        """
+        self.queue.put((list(segments), callback))
+
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        self.is_active = False
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while self.is_active or not self.queue.empty():
+            batch = [self.queue.get()]
+
+            while len(batch) < MAX_BATCH_JOBS:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            jobs = [job for job in batch if job is not None]
+
+            try:
+                self._write_batch([segment for segments, _ in jobs for segment in segments])
+
+                for _, callback in jobs:
+                    if callback:
+                        callback()
+            except Exception:
+                logging.exception("Can't write to file")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+        self._close_files()
+
+    def _write_batch(self, segments):
+        segments.sort(key=lambda segment: (segment[0], segment[1]))
+
+        run_path, run_offset, run_end, run_buffers = None, 0, 0, []
+
+        for path, file_offset, data in segments:
+            if path == run_path and file_offset == run_end and len(run_buffers) < IOV_MAX:
+                run_buffers.append(data)
+                run_end += len(data)
+                continue
+
+            if run_buffers:
+                self._pwritev(run_path, run_offset, run_buffers)
+
+            run_path, run_offset, run_end, run_buffers = path, file_offset, file_offset + len(data), [data]
+
+        if run_buffers:
+            self._pwritev(run_path, run_offset, run_buffers)
+
+    def _pwritev(self, path, offset, buffers):
+        fd = self._get_file_descriptor(path)
+        buffers = [memoryview(data).cast('B') for data in buffers]
+
+        while buffers:
+            written = os.pwritev(fd, buffers, offset)
+            offset += written
+
+            # short write: skip what has been written and retry with the rest
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and written:
+                buffers[0] = buffers[0][written:]
+
+    def _get_file_descriptor(self, path):
+        fd = self.file_descriptors.get(path)
+
+        if fd is not None:
+            self.file_descriptors.move_to_end(path)
+            return fd
+
+        if len(self.file_descriptors) >= self.max_open_files:
+            _, oldest_fd = self.file_descriptors.popitem(last=False)
+            os.close(oldest_fd)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.file_descriptors[path] = fd
+        return fd
+
+    def _close_files(self):
+        for fd in self.file_descriptors.values():
+            os.close(fd)
+
+        self.file_descriptors.clear()
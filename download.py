@@ -1,79 +1,93 @@
 import sys
-from block import State
 import time
 import peers_manager
 import pieces_manager
 import torrent
 import tracker
+from peer_listener import PeerListener
 import logging
 import os
-import message
+from pubsub import pub
 
 
 class Run(object):
     percentage_completed = -1
     last_log_line = ""
 
-    def __init__(self):
-        try:
-            torrent_file = sys.argv[1]
-        except IndexError:
-            logging.error("No torrent file provided!")
-            sys.exit(0)
+    def __init__(self, torrent_file=None, session=None):
+        """
+            :param session: Session sharing its event loop, listening port, tracker clients and disk threads with
+            this torrent's. Standalone, the torrent has its own.
+        """
+        if torrent_file is None:
+            try:
+                torrent_file = sys.argv[1]
+            except IndexError:
+                logging.error("No torrent file provided!")
+                sys.exit(0)
         self.torrent = torrent.Torrent().load_from_path(torrent_file)
-        self.tracker = tracker.Tracker(self.torrent)
-
-        self.pieces_manager = pieces_manager.PiecesManager(self.torrent)
-        self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager)
+        self.session = session
+
+        if session is None:
+            self.tracker = tracker.Tracker(self.torrent)
+            self.pieces_manager = pieces_manager.PiecesManager(self.torrent)
+            self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager)
+            self.peer_listener = PeerListener(self.peers_manager.loop)
+            self.peer_listener.start()
+
+        else:
+            if session.get_torrent(self.torrent.info_hash) is not None:
+                raise ValueError("Torrent already in the session: %s" % torrent_file)
+
+            self.tracker = tracker.Tracker(self.torrent, session.udp_client, session.http_client,
+                                           session.announce_executor)
+            self.pieces_manager = pieces_manager.PiecesManager(self.torrent, session.verifier, session.disk_writer)
+            self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager,
+                                                            event_loop=session.event_loop, budget=session.budget)
+            self.peer_listener = session.peer_listener
 
         self.peers_manager.start()
         logging.info("PeersManager Started")
+
+        self.peer_listener.add_torrent(self.peers_manager)
         logging.info("PiecesManager Started")
 
     def run(self, status):
         if status == 'starting':
-            self.peers_dict = self.tracker.get_peers_from_trackers()
-            self.peers_manager.add_peers(self.peers_dict.values())
+            self.announce()
 
         elif status == 'running':
+            self.announce()
+
             if not self.peers_manager.has_unchoked_peers():
                 logging.info("No unchocked peers")
             else:
-                for piece in self.pieces_manager.pieces:
-                    index = piece.piece_index
-    
-                    if self.pieces_manager.pieces[index].is_full:
-                        continue
-                    
-                    peer = self.peers_manager.get_random_peer_having_piece(index)
-                    if not peer:
-                        continue
-                    
-                    self.pieces_manager.pieces[index].update_block_status()
-    
-                    data = self.pieces_manager.pieces[index].get_empty_block()
-                    if not data:
-                        continue
-                    
-                    piece_index, block_offset, block_length = data
-                    piece_data = message.Request(piece_index, block_offset, block_length).to_bytes()
-                    peer.send_to_peer(piece_data)
-    
+                self.peers_manager.schedule_requests()
                 self.display_progression()
-    
-    
+
+        elif status == 'seeding':
+            self.announce()
+
         #logging.info("File(s) downloaded successfully.")
         #self.display_progression()
 
         #self._exit_threads()
 
-    def display_progression(self):
-        new_progression = 0
+    def announce(self):
+        self.tracker.update_transfer(self.peers_manager.uploaded_length, self.pieces_manager.downloaded_length,
+                                     self.torrent.total_length - self.pieces_manager.completed_length)
+        # only a download announces early for peers, a seed keeps to the interval of the trackers
+        need_peers = self.peers_manager.needs_peers() and not self.pieces_manager.all_pieces_completed()
+        self.tracker.get_peers_from_trackers(self.peers_manager.add_peers, need_peers)
+
+    def set_bandwidth_limits(self, upload_rate=None, download_rate=None):
+        """
+            Limits of this torrent in bytes per second, 0 for unlimited; bandwidth.global_limits caps all torrents
+        """
+        self.peers_manager.set_limits(upload_rate, download_rate)
 
-        for i in range(self.pieces_manager.number_of_pieces):
-            for j in range(self.pieces_manager.pieces[i].number_of_blocks):
-                if self.pieces_manager.pieces[i].blocks[j].state == State.FULL:
-                    new_progression += len(self.pieces_manager.pieces[i].blocks[j].data)
+    def display_progression(self):
+        new_progression = self.pieces_manager.downloaded_length
 
         if new_progression == self.percentage_completed:
             return
@@ -91,7 +105,30 @@ class Run(object):
         self.last_log_line = current_log_line
         self.percentage_completed = new_progression
 
+    def stop(self):
+        """
+            Stops this torrent. The parts shared with the session keep running.
+        """
+        self.tracker.stop()
+        self.peer_listener.remove_torrent(self.peers_manager)
+
+        if self.session is None:
+            self.peer_listener.stop()
+
+        self.peers_manager.stop()
+
+        if self.session is None:
+            self.pieces_manager.verifier.shutdown()
+            self.pieces_manager.disk_writer.stop()
+            self.pieces_manager.storage.close()
+        else:
+            # After the peers are disconnected, on the event loop: nothing publishes on the topics or reads
+            # from the files past that
+            loop = self.peers_manager.loop
+            loop.call_soon_threadsafe(pub.getDefaultTopicMgr().delTopic, self.torrent.topic_root)
+            loop.call_soon_threadsafe(self.pieces_manager.storage.close)
+
     def _exit_threads(self):
-        self.peers_manager.is_active = False
+        self.stop()
         os._exit(0)
 
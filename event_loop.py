@@ -0,0 +1,34 @@
+import asyncio
+from threading import Thread
+
+
+class EventLoopThread(Thread):
+    """
+        Runs the asyncio event loop of the peer connections. A standalone PeersManager has its own,
+        a Session shares one between all its torrents.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='EventLoop')
+        self.loop = asyncio.new_event_loop()
+
+    def is_current(self):
+        """
+            True when called from the loop thread
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(asyncio.sleep(0))  # lets the cancelled tasks finish
+            self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
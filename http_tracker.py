@@ -0,0 +1,72 @@
+import socket
+from struct import Struct
+
+import requests
+from requests.adapters import HTTPAdapter
+from bcoding import bdecode
+
+HTTP_TRACKER_TIMEOUT = 5
+MAX_POOLED_CONNECTIONS = 32  # per tracker host, one per concurrent announce
+
+COMPACT_PEER_STRUCT = Struct(">4sH")
+COMPACT_PEER6_STRUCT = Struct(">16sH")
+
+
+class HttpTrackerError(Exception):
+    pass
+
+
+class HttpTrackerClient(object):
+    """
+        HTTP tracker client over one pooled requests session: connections to a tracker are kept alive
+        between announces, so re-announces skip DNS, TCP and TLS setup. Always asks for compact
+        peer lists and gzip bodies.
+    """
+
+    def __init__(self, max_pooled_connections=MAX_POOLED_CONNECTIONS):
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+
+        adapter = HTTPAdapter(pool_connections=max_pooled_connections, pool_maxsize=max_pooled_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def announce(self, url, params):
+        """
+            :return: (bdecoded answer, list of (ip, port))
+        """
+        params = dict(params, compact=1, no_peer_id=1)
+
+        answer = self.session.get(url, params=params, timeout=HTTP_TRACKER_TIMEOUT)
+        answer.raise_for_status()
+        decoded_answer = bdecode(answer.content)
+
+        if 'failure reason' in decoded_answer:
+            raise HttpTrackerError("Tracker failure: %s" % decoded_answer['failure reason'])
+
+        return decoded_answer, self.parse_peers(decoded_answer)
+
+    def close(self):
+        self.session.close()
+
+    @staticmethod
+    def parse_peers(decoded_answer):
+        peers = decoded_answer.get('peers', b'')
+
+        if isinstance(peers, list):  # tracker ignoring compact=1
+            sock_addrs = [(p['ip'], p['port']) for p in peers]
+        else:
+            sock_addrs = [(socket.inet_ntoa(ip), port)
+                          for ip, port in _iter_compact(COMPACT_PEER_STRUCT, peers)]
+
+        sock_addrs.extend((socket.inet_ntop(socket.AF_INET6, ip), port)
+                          for ip, port in _iter_compact(COMPACT_PEER6_STRUCT, decoded_answer.get('peers6', b'')))
+
+        return sock_addrs
+
+
+def _iter_compact(peer_struct, peers):
+    if isinstance(peers, str):  # bdecode gives str for byte strings that happen to be valid utf-8
+        peers = peers.encode('utf-8')
+
+    return peer_struct.iter_unpack(peers[:len(peers) - len(peers) % peer_struct.size])
@@ -43,6 +43,13 @@ class Hypervisor:
         }
 
     def start(self):
+        self.begin()
+
+        while self.attributes['status'] != 'terminated':
+            self.step()
+            time.sleep(0.1)
+
+    def begin(self):
         length = self.download.torrent.total_length
         if 1000000 > length:
             self.attributes['size_magnitude'] = [1000, 'KB']
@@ -64,18 +71,20 @@ class Hypervisor:
         
         self.attributes['status'] = 'starting'
 
-        while self.attributes['status'] != 'terminated':
-            self.download.run(self.attributes['status'])
+    def step(self):
+        """
+            One turn of the status loop. A Session steps all its torrents from a single thread.
+        """
+        self.download.run(self.attributes['status'])
 
-            self.downloaded_stats()
-            print(f"DOWNLOADED = {self.attributes['downloaded']}")
-            
-            if not self.download.pieces_manager.all_pieces_completed():
-                self.attributes['status'] == 'running'
-            else:
-                self.attributes['status'] == 'seeding'
+        self.downloaded_stats()
+        self.calculate_speed()
+        print(f"DOWNLOADED = {self.attributes['downloaded']}")
 
-            time.sleep(0.1)
+        if not self.download.pieces_manager.all_pieces_completed():
+            self.attributes['status'] = 'running'
+        else:
+            self.attributes['status'] = 'seeding'
 
     def downloaded_stats(self):
         amount = (self.download.pieces_manager.complete_pieces / self.download.pieces_manager.number_of_pieces) \
@@ -88,5 +97,23 @@ class Hypervisor:
             self.attributes['downloaded'] = f'{amount / 1000000000} GB'
 
     def calculate_speed(self):
-        pass
+        """
+            Download and upload speeds in bytes per second over the last few seconds, and estimated
+            seconds to finish at the current download speed (None while nothing is downloaded)
+        """
+        peers_manager = self.download.peers_manager
+        download_speed = peers_manager.download_meter.rate()
+        remaining = self.download.torrent.total_length - self.download.pieces_manager.completed_length
+
+        self.attributes['download_speed'] = download_speed
+        self.attributes['upload_speed'] = peers_manager.upload_meter.rate()
+        self.attributes['connected_peers'] = len(peers_manager.peers)
+        self.attributes['time_elapsed'] = time.time() - self.attributes['time_began']
+
+        if remaining == 0:
+            self.attributes['estimated_finish'] = 0.0
+        elif download_speed > 0:
+            self.attributes['estimated_finish'] = remaining / download_speed
+        else:
+            self.attributes['estimated_finish'] = None
         
\ No newline at end of file
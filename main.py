@@ -1,13 +1,20 @@
-from download import Run
-from hypervisor import Hypervisor
+import sys
+from session import Session
 import logging
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
-    id = 1
+    if len(sys.argv) < 2:
+        logging.error("No torrent file provided!")
+        sys.exit(0)
 
-    download = Run()
-    hypervisor = Hypervisor(download, id)
-    id += 1
-    hypervisor.start()
\ No newline at end of file
+    session = Session()
+
+    for torrent_file in sys.argv[1:]:
+        try:
+            session.add_torrent(torrent_file)
+        except ValueError as e:
+            logging.error(e.__str__())
+
+    session.run()
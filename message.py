@@ -1,20 +1,38 @@
 import logging
 import random
 import socket
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 
 # HandShake - String identifier of the protocol for BitTorrent V1
 import bitstring
 
+from receive_buffer import ReceiveBuffer
+
 HANDSHAKE_PSTR_V1 = b"BitTorrent protocol"
 HANDSHAKE_PSTR_LEN = len(HANDSHAKE_PSTR_V1)
 LENGTH_PREFIX = 4
+MAX_REQUEST_LENGTH = 2 ** 17  # longest block requested or served
+
+# Precompiled wire headers
+LENGTH_STRUCT = Struct(">I")
+HEADER_STRUCT = Struct(">IB")
+INDEX_MESSAGE_STRUCT = Struct(">IBI")
+BLOCK_MESSAGE_STRUCT = Struct(">IBIII")
+PIECE_HEADER_STRUCT = Struct(">IBII")
+HANDSHAKE_STRUCT = Struct(">B{}s8s20s20s".format(HANDSHAKE_PSTR_LEN))
 
 
 class WrongMessageException(Exception):
     pass
 
 
+def max_frame_length(number_of_pieces):
+    """
+        Longest legal message with its length prefix: a Piece of MAX_REQUEST_LENGTH or a BitField
+    """
+    return max(PIECE_HEADER_STRUCT.size + MAX_REQUEST_LENGTH, LENGTH_PREFIX + 1 + (number_of_pieces + 7) // 8)
+
+
 class MessageDispatcher:
 
     def __init__(self, payload):
@@ -22,28 +40,95 @@ class MessageDispatcher:
 
     def dispatch(self):
         try:
-            payload_length, message_id, = unpack(">IB", self.payload[:5])
+            payload_length, message_id, = HEADER_STRUCT.unpack_from(self.payload)
         except Exception as e:
             logging.warning("Error when unpacking message : %s" % e.__str__())
             return None
 
-        map_id_to_message = {
-            0: Choke,
-            1: UnChoke,
-            2: Interested,
-            3: NotInterested,
-            4: Have,
-            5: BitField,
-            6: Request,
-            7: Piece,
-            8: Cancel,
-            9: Port
-        }
-
-        if message_id not in list(map_id_to_message.keys()):
+        message_class = MESSAGE_ID_TO_CLASS.get(message_id)
+        if message_class is None:
             raise WrongMessageException("Wrong message id")
 
-        return map_id_to_message[message_id].from_bytes(self.payload)
+        return message_class.from_bytes(self.payload)
+
+
+class MessageParser(object):
+    """
+        Incremental parser of the peer wire protocol.
+
+        Bytes are either received in place through get_buffer/buffer_updated (asyncio.BufferedProtocol)
+        or copied in with feed(). messages() then yields every complete message: the Handshake first,
+        then KeepAlive and typed messages. A Piece block is a memoryview of the receive buffer and is
+        only valid until more bytes are received.
+        A frame longer than max_frame_length raises WrongMessageException before anything is allocated for it.
+    """
+
+    def __init__(self, max_frame_length=None):
+        self.buffer = ReceiveBuffer()
+        self.has_handshaked = False
+        self.max_frame_length = max_frame_length
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def get_buffer(self, sizehint=-1):
+        return self.buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.buffer.buffer_updated(nbytes)
+
+    def feed(self, data):
+        length = len(data)
+        self.buffer.get_buffer(length)[:length] = data
+        self.buffer.buffer_updated(length)
+
+    def messages(self):
+        buffer = self.buffer
+
+        if not self.has_handshaked:
+            if len(buffer) < Handshake.total_length:
+                return
+
+            handshake = Handshake.from_bytes(buffer.peek(Handshake.total_length))
+            buffer.consume(Handshake.total_length)
+            self.has_handshaked = True
+            yield handshake
+
+        data, view = buffer.buffer, buffer.view
+        start, end = buffer.start, buffer.end
+        unpack_length = LENGTH_STRUCT.unpack_from
+        message_classes = MESSAGE_ID_TO_CLASS
+        max_frame_length = self.max_frame_length
+
+        while end - start >= LENGTH_PREFIX:
+            payload_length, = unpack_length(data, start)
+            stop = start + LENGTH_PREFIX + payload_length
+
+            if max_frame_length is not None and stop - start > max_frame_length:
+                raise WrongMessageException("Message too long (%d bytes)" % payload_length)
+
+            if stop > end:
+                buffer.reserve(stop - start)
+                return
+
+            payload = view[start:stop]
+            message_id = data[start + LENGTH_PREFIX] if payload_length else None
+            start = stop
+            buffer.consume(stop - buffer.start)
+
+            if message_id is None:
+                yield KEEP_ALIVE
+                continue
+
+            message_class = message_classes.get(message_id)
+            if message_class is None:
+                logging.debug("Unknown message id %d (length %d)" % (message_id, payload_length))
+                continue
+
+            try:
+                yield message_class.from_bytes(payload)
+            except Exception as e:
+                logging.warning("Malformed message id %d : %s" % (message_id, e.__str__()))
 
 
 class Message:
@@ -74,7 +159,7 @@ class UdpTrackerConnection(Message):
         super(UdpTrackerConnection, self).__init__()
         self.conn_id = pack('>Q', 0x41727101980)
         self.action = pack('>I', 0)
-        self.trans_id = pack('>I', random.randint(0, 100000))
+        self.trans_id = pack('>I', random.getrandbits(32))
 
     def to_bytes(self):
         return self.conn_id + self.action + self.trans_id
@@ -110,27 +195,32 @@ class UdpTrackerAnnounce(Message):
         Total length = 64 + 32 + 32 = 128 bytes
     """
 
-    def __init__(self, info_hash, conn_id, peer_id):
+    def __init__(self, info_hash, conn_id, peer_id, downloaded=0, left=0, uploaded=0, event=0, port=6881):
         super(UdpTrackerAnnounce, self).__init__()
         self.peer_id = peer_id
         self.conn_id = conn_id
         self.info_hash = info_hash
-        self.trans_id = pack('>I', random.randint(0, 100000))
+        self.downloaded = downloaded
+        self.left = left
+        self.uploaded = uploaded
+        self.event = event  # 0: none, 1: completed, 2: started, 3: stopped
+        self.port = port
+        self.trans_id = pack('>I', random.getrandbits(32))
         self.action = pack('>I', 1)
 
     def to_bytes(self):
         conn_id = pack('>Q', self.conn_id)
         action = self.action
         trans_id = self.trans_id
-        downloaded = pack('>Q', 0)
-        left = pack('>Q', 0)
-        uploaded = pack('>Q', 0)
+        downloaded = pack('>Q', self.downloaded)
+        left = pack('>Q', self.left)
+        uploaded = pack('>Q', self.uploaded)
 
-        event = pack('>I', 0)
+        event = pack('>I', self.event)
         ip = pack('>I', 0)
         key = pack('>I', 0)
         num_want = pack('>i', -1)
-        port = pack('>h', 8000)
+        port = pack('>H', self.port)
 
         msg = (conn_id + action + trans_id + self.info_hash + self.peer_id + downloaded +
                left + uploaded + event + ip + key + num_want + port)
@@ -138,6 +228,49 @@ class UdpTrackerAnnounce(Message):
         return msg
 
 
+class UdpTrackerScrape(Message):
+    """
+        scrape = <connection_id><action><transaction_id><info_hash>...
+
+        0	64-bit integer	connection_id
+8	32-bit integer	action	2
+12	32-bit integer	transaction_id
+16 + 20 * n	20-byte string	info_hash
+    """
+
+    def __init__(self, conn_id, info_hashes):
+        super(UdpTrackerScrape, self).__init__()
+        self.conn_id = conn_id
+        self.info_hashes = info_hashes
+        self.trans_id = pack('>I', random.getrandbits(32))
+        self.action = pack('>I', 2)
+
+    def to_bytes(self):
+        return pack('>Q', self.conn_id) + self.action + self.trans_id + b''.join(self.info_hashes)
+
+
+class UdpTrackerScrapeOutput:
+    """
+        scrape output = <action><transaction_id>(<seeders><completed><leechers>)...
+
+0	32-bit integer	action	2
+4	32-bit integer	transaction_id
+8 + 12 * n	32-bit integer	seeders
+12 + 12 * n	32-bit integer	completed
+16 + 12 * n	32-bit integer	leechers
+    """
+
+    def __init__(self):
+        self.action = None
+        self.transaction_id = None
+        self.stats = []
+
+    def from_bytes(self, payload):
+        self.action, = unpack('>I', payload[:4])
+        self.transaction_id, = unpack('>I', payload[4:8])
+        self.stats = [unpack('>III', payload[offset:offset + 12]) for offset in range(8, len(payload) - 11, 12)]
+
+
 class UdpTrackerAnnounceOutput:
     """
         connect = <connection_id><action><transaction_id>
@@ -215,22 +348,20 @@ class Handshake(Message):
 
     def to_bytes(self):
         reserved = b'\x00' * 8
-        handshake = pack(">B{}s8s20s20s".format(HANDSHAKE_PSTR_LEN),
-                         HANDSHAKE_PSTR_LEN,
-                         HANDSHAKE_PSTR_V1,
-                         reserved,
-                         self.info_hash,
-                         self.peer_id)
+        handshake = HANDSHAKE_STRUCT.pack(HANDSHAKE_PSTR_LEN,
+                                          HANDSHAKE_PSTR_V1,
+                                          reserved,
+                                          self.info_hash,
+                                          self.peer_id)
 
         return handshake
 
     @classmethod
     def from_bytes(cls, payload):
-        pstrlen, = unpack(">B", payload[:1])
-        pstr, reserved, info_hash, peer_id = unpack(">{}s8s20s20s".format(pstrlen), payload[1:cls.total_length])
+        pstrlen, pstr, reserved, info_hash, peer_id = HANDSHAKE_STRUCT.unpack_from(payload)
 
-        if pstr != HANDSHAKE_PSTR_V1:
-            raise ValueError("Invalid string identifier of the protocol")
+        if pstrlen != HANDSHAKE_PSTR_LEN or pstr != HANDSHAKE_PSTR_V1:
+            raise WrongMessageException("Invalid string identifier of the protocol")
 
         return Handshake(info_hash, peer_id)
 
@@ -247,11 +378,11 @@ class KeepAlive(Message):
         super(KeepAlive, self).__init__()
 
     def to_bytes(self):
-        return pack(">I", self.payload_length)
+        return LENGTH_STRUCT.pack(self.payload_length)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length = unpack(">I", payload[:cls.total_length])
+        payload_length, = LENGTH_STRUCT.unpack_from(payload)
 
         if payload_length != 0:
             raise WrongMessageException("Not a Keep Alive message")
@@ -275,11 +406,11 @@ class Choke(Message):
         super(Choke, self).__init__()
 
     def to_bytes(self):
-        return pack(">IB", self.payload_length, self.message_id)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id = unpack(">IB", payload[:cls.total_length])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Choke message")
 
@@ -302,11 +433,11 @@ class UnChoke(Message):
         super(UnChoke, self).__init__()
 
     def to_bytes(self):
-        return pack(">IB", self.payload_length, self.message_id)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id = unpack(">IB", payload[:cls.total_length])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not an UnChoke message")
@@ -330,11 +461,11 @@ class Interested(Message):
         super(Interested, self).__init__()
 
     def to_bytes(self):
-        return pack(">IB", self.payload_length, self.message_id)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id = unpack(">IB", payload[:cls.total_length])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not an Interested message")
@@ -358,15 +489,15 @@ class NotInterested(Message):
         super(NotInterested, self).__init__()
 
     def to_bytes(self):
-        return pack(">IB", self.payload_length, self.message_id)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id = unpack(">IB", payload[:cls.total_length])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Non Interested message")
 
-        return Interested()
+        return NotInterested()
 
 
 class Have(Message):
@@ -386,11 +517,11 @@ class Have(Message):
         self.piece_index = piece_index
 
     def to_bytes(self):
-        pack(">IBI", self.payload_length, self.message_id, self.piece_index)
+        return INDEX_MESSAGE_STRUCT.pack(self.payload_length, self.message_id, self.piece_index)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id, piece_index = unpack(">IBI", payload[:cls.total_length])
+        payload_length, message_id, piece_index = INDEX_MESSAGE_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Have message")
 
@@ -420,21 +551,17 @@ class BitField(Message):
         self.total_length = 4 + self.payload_length
 
     def to_bytes(self):
-        return pack(">IB{}s".format(self.bitfield_length),
-                    self.payload_length,
-                    self.message_id,
-                    self.bitfield_as_bytes)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id) + self.bitfield_as_bytes
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id = unpack(">IB", payload[:5])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
         bitfield_length = payload_length - 1
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a BitField message")
 
-        raw_bitfield, = unpack(">{}s".format(bitfield_length), payload[5:5 + bitfield_length])
-        bitfield = bitstring.BitArray(bytes=bytes(raw_bitfield))
+        bitfield = bitstring.BitArray(bytes=bytes(payload[5:5 + bitfield_length]))
 
         return BitField(bitfield)
 
@@ -461,17 +588,15 @@ class Request(Message):
         self.block_length = block_length
 
     def to_bytes(self):
-        return pack(">IBIII",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block_length)
+        return BLOCK_MESSAGE_STRUCT.pack(self.payload_length,
+                                         self.message_id,
+                                         self.piece_index,
+                                         self.block_offset,
+                                         self.block_length)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id, piece_index, block_offset, block_length = unpack(">IBIII",
-                                                                                     payload[:cls.total_length])
+        payload_length, message_id, piece_index, block_offset, block_length = BLOCK_MESSAGE_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Request message")
 
@@ -486,6 +611,8 @@ class Piece(Message):
         - piece index =  zero based piece index (4 bytes)
         - block offset = zero based of the requested block (4 bytes)
         - block = block as a bytestring or bytearray (block_length bytes)
+
+        When parsed from the wire, block is a memoryview of the receive buffer.
     """
     message_id = 7
 
@@ -503,24 +630,25 @@ class Piece(Message):
         self.payload_length = 9 + block_length
         self.total_length = 4 + self.payload_length
 
+    def header_to_bytes(self):
+        return PIECE_HEADER_STRUCT.pack(self.payload_length,
+                                        self.message_id,
+                                        self.piece_index,
+                                        self.block_offset)
+
     def to_bytes(self):
-        return pack(">IBII{}s".format(self.block_length),
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block)
+        return self.header_to_bytes() + self.block
 
     @classmethod
     def from_bytes(cls, payload):
-        block_length = len(payload) - 13
-        payload_length, message_id, piece_index, block_offset, block = unpack(">IBII{}s".format(block_length),
-                                                                              payload[:13 + block_length])
+        payload_length, message_id, piece_index, block_offset = PIECE_HEADER_STRUCT.unpack_from(payload)
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Piece message")
 
-        return Piece(block_length, piece_index, block_offset, block)
+        block = memoryview(payload)[PIECE_HEADER_STRUCT.size:LENGTH_PREFIX + payload_length]
+
+        return Piece(len(block), piece_index, block_offset, block)
 
 
 class Cancel(Message):
@@ -543,17 +671,15 @@ class Cancel(Message):
         self.block_length = block_length
 
     def to_bytes(self):
-        return pack(">IBIII",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block_length)
+        return BLOCK_MESSAGE_STRUCT.pack(self.payload_length,
+                                         self.message_id,
+                                         self.piece_index,
+                                         self.block_offset,
+                                         self.block_length)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id, piece_index, block_offset, block_length = unpack(">IBIII",
-                                                                                     payload[:cls.total_length])
+        payload_length, message_id, piece_index, block_offset, block_length = BLOCK_MESSAGE_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Cancel message")
 
@@ -578,16 +704,31 @@ class Port(Message):
         self.listen_port = listen_port
 
     def to_bytes(self):
-        return pack(">IBI",
-                    self.payload_length,
-                    self.message_id,
-                    self.listen_port)
+        return INDEX_MESSAGE_STRUCT.pack(self.payload_length,
+                                         self.message_id,
+                                         self.listen_port)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id, listen_port = unpack(">IBI", payload[:cls.total_length])
+        payload_length, message_id, listen_port = INDEX_MESSAGE_STRUCT.unpack_from(payload)
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Port message")
 
         return Port(listen_port)
+
+
+KEEP_ALIVE = KeepAlive()
+
+MESSAGE_ID_TO_CLASS = {
+    Choke.message_id: Choke,
+    UnChoke.message_id: UnChoke,
+    Interested.message_id: Interested,
+    NotInterested.message_id: NotInterested,
+    Have.message_id: Have,
+    BitField.message_id: BitField,
+    Request.message_id: Request,
+    Piece.message_id: Piece,
+    Cancel.message_id: Cancel,
+    Port.message_id: Port
+}
@@ -1,24 +1,39 @@
 import time
-import socket
-import struct
 import bitstring
+from collections import deque
 from pubsub import pub
 import logging
 
 import message
+from block import BLOCK_REQUEST_TIMEOUT
+from rate_meter import RateMeter
+from bandwidth import BandwidthLimits
+
+# Outstanding block requests per peer: the window grows by one block each time a block arrives
+# while it is full, and is halved when a request times out
+REQUEST_PIPELINE_SIZE = 16
+MIN_REQUEST_PIPELINE_SIZE = 4
+MAX_REQUEST_PIPELINE_SIZE = 256
 
 
 class Peer(object):
-    def __init__(self, number_of_pieces, ip, port=6881):
-        self.last_call = 0.0
+    def __init__(self, torrent, number_of_pieces, ip, port=6881):
+        self.connected_at = 0.0
         self.has_handshaked = False
         self.healthy = False
-        self.read_buffer = b''
-        self.socket = None
+        self.parser = message.MessageParser(message.max_frame_length(number_of_pieces))
+        self.protocol = None
+        self.torrent = torrent
         self.ip = ip
         self.port = port
         self.number_of_pieces = number_of_pieces
         self.bit_field = bitstring.BitArray(number_of_pieces)
+        self.outstanding_requests = {}
+        self.download_meter = RateMeter()
+        self.upload_meter = RateMeter()
+        self.limits = BandwidthLimits()
+        self.upload_requests = deque()  # requests from the peer waiting for upload bandwidth
+        self.request_pipeline_size = REQUEST_PIPELINE_SIZE
         self.state = {
             'am_choking': True,
             'am_interested': False,
@@ -27,32 +42,53 @@ class Peer(object):
         }
 
     def __hash__(self):
-        return "%s:%d" % (self.ip, self.port)
+        return hash((self.ip, self.port))
 
-    def connect(self):
+    def send_to_peer(self, msg):
         try:
-            self.socket = socket.create_connection((self.ip, self.port), timeout=2)
-            self.socket.setblocking(False)
-            logging.debug("Connected to peer ip: {} - port: {}".format(self.ip, self.port))
-            self.healthy = True
-
+            self.protocol.write(msg)
         except Exception as e:
-            print("Failed to connect to peer (ip: %s - port: %s - %s)" % (self.ip, self.port, e.__str__()))
-            return False
+            self.healthy = False
+            logging.error("Failed to send to peer : %s" % e.__str__())
 
-        return True
+    def request_slots(self):
+        return self.request_pipeline_size - len(self.outstanding_requests)
 
-    def send_to_peer(self, msg):
+    def send_file_to_peer(self, header, segments):
         try:
-            self.socket.send(msg)
-            self.last_call = time.time()
+            self.protocol.send_file(header, segments)
         except Exception as e:
             self.healthy = False
             logging.error("Failed to send to peer : %s" % e.__str__())
 
-    def is_eligible(self):
+    def send_request(self, piece_index, block_offset, block_length):
+        self.outstanding_requests[(piece_index, block_offset)] = time.time()
+        self.send_to_peer(message.Request(piece_index, block_offset, block_length).to_bytes())
+
+    def send_cancel(self, piece_index, block_offset, block_length):
+        self.outstanding_requests.pop((piece_index, block_offset), None)
+        self.send_to_peer(message.Cancel(piece_index, block_offset, block_length).to_bytes())
+
+    def expire_requests(self):
         now = time.time()
-        return (now - self.last_call) > 0.2
+        expired = [key for key, sent_at in self.outstanding_requests.items()
+                   if now - sent_at > BLOCK_REQUEST_TIMEOUT]
+
+        for key in expired:
+            del self.outstanding_requests[key]
+
+        if expired:
+            self.request_pipeline_size = max(MIN_REQUEST_PIPELINE_SIZE, self.request_pipeline_size // 2)
+
+        return expired
+
+    def has_request(self, piece_index, block_offset):
+        return (piece_index, block_offset) in self.outstanding_requests
+
+    def clear_requests(self):
+        requests = list(self.outstanding_requests)
+        self.outstanding_requests.clear()
+        return requests
 
     def has_piece(self, index):
         return self.bit_field[index]
@@ -75,6 +111,29 @@ class Peer(object):
     def am_interested(self):
         return self.state['am_interested']
 
+    def set_interested(self, interested):
+        if interested == self.am_interested():
+            return
+
+        if interested:
+            self.send_to_peer(message.Interested().to_bytes())
+        else:
+            self.send_to_peer(message.NotInterested().to_bytes())
+
+        self.state['am_interested'] = interested
+
+    def set_choking(self, choking):
+        if choking == self.am_choking():
+            return
+
+        if choking:
+            self.upload_requests.clear()  # a choked peer's requests are dropped
+            self.send_to_peer(message.Choke().to_bytes())
+        else:
+            self.send_to_peer(message.UnChoke().to_bytes())
+
+        self.state['am_choking'] = choking
+
     def handle_choke(self):
         logging.debug('handle_choke - %s' % self.ip)
         self.state['peer_choking'] = True
@@ -87,10 +146,6 @@ class Peer(object):
         logging.debug('handle_interested - %s' % self.ip)
         self.state['peer_interested'] = True
 
-        if self.am_choking():
-            unchoke = message.UnChoke().to_bytes()
-            self.send_to_peer(unchoke)
-
     def handle_not_interested(self):
         logging.debug('handle_not_interested - %s' % self.ip)
         self.state['peer_interested'] = False
@@ -100,14 +155,9 @@ class Peer(object):
         :type have: message.Have
         """
         logging.debug('handle_have - ip: %s - piece: %s' % (self.ip, have.piece_index))
-        self.bit_field[have.piece_index] = True
-
-        if self.is_choking() and not self.state['am_interested']:
-            interested = message.Interested().to_bytes()
-            self.send_to_peer(interested)
-            self.state['am_interested'] = True
-
-        # pub.sendMessage('RarestPiece.updatePeersBitfield', bitfield=self.bit_field)
+        if have.piece_index < self.number_of_pieces and not self.bit_field[have.piece_index]:
+            self.bit_field[have.piece_index] = True
+            pub.sendMessage(self.torrent.topic('RarestPiece.peerHasPiece'), peer=self, piece_index=have.piece_index)
 
     def handle_bitfield(self, bitfield):
         """
@@ -115,78 +165,66 @@ class Peer(object):
         """
         logging.debug('handle_bitfield - %s - %s' % (self.ip, bitfield.bitfield))
         self.bit_field = bitfield.bitfield
-
-        if self.is_choking() and not self.state['am_interested']:
-            interested = message.Interested().to_bytes()
-            self.send_to_peer(interested)
-            self.state['am_interested'] = True
-
-        # pub.sendMessage('RarestPiece.updatePeersBitfield', bitfield=self.bit_field)
+        pub.sendMessage(self.torrent.topic('RarestPiece.updatePeersBitfield'), peer=self, bitfield=self.bit_field)
 
     def handle_request(self, request):
         """
         :type request: message.Request
         """
         logging.debug('handle_request - %s' % self.ip)
-        if self.is_interested() and self.is_unchoked():
-            pub.sendMessage('PiecesManager.PeerRequestsPiece', request=request, peer=self)
+        if self.is_interested() and self.am_unchoking():
+            pub.sendMessage(self.torrent.topic('PeersManager.PeerRequestsPiece'), request=request, peer=self)
 
     def handle_piece(self, message):
         """
         :type message: message.Piece
         """
-        pub.sendMessage('PiecesManager.Piece', piece=(message.piece_index, message.block_offset, message.block))
+        key = (message.piece_index, message.block_offset)
+
+        if key in self.outstanding_requests:
+            if len(self.outstanding_requests) >= self.request_pipeline_size:
+                self.request_pipeline_size = min(MAX_REQUEST_PIPELINE_SIZE, self.request_pipeline_size + 1)
+            del self.outstanding_requests[key]
 
-    def handle_cancel(self):
+        self.download_meter.add(len(message.block))
+        pub.sendMessage(self.torrent.topic('PiecesManager.Piece'),
+                        piece=(message.piece_index, message.block_offset, message.block))
+
+    def handle_cancel(self, cancel):
+        """
+        :type cancel: message.Cancel
+        """
         logging.debug('handle_cancel - %s' % self.ip)
 
+        for request in self.upload_requests:
+            if (request.piece_index, request.block_offset, request.block_length) == \
+                    (cancel.piece_index, cancel.block_offset, cancel.block_length):
+                self.upload_requests.remove(request)
+                break
+
     def handle_port_request(self):
         logging.debug('handle_port_request - %s' % self.ip)
 
-    def _handle_handshake(self):
-        try:
-            handshake_message = message.Handshake.from_bytes(self.read_buffer)
-            self.has_handshaked = True
-            self.read_buffer = self.read_buffer[handshake_message.total_length:]
-            logging.debug('handle_handshake - %s' % self.ip)
-            return True
-
-        except Exception:
-            logging.exception("First message should always be a handshake message")
-            self.healthy = False
-
-        return False
-
-    def _handle_keep_alive(self):
+    def get_messages(self):
+        """
+            Yields the messages available in the receive buffer. They are built over memoryviews
+            of the buffer, so they must be handled before more data is received.
+        """
         try:
-            keep_alive = message.KeepAlive.from_bytes(self.read_buffer)
-            logging.debug('handle_keep_alive - %s' % self.ip)
-        except message.WrongMessageException:
-            return False
-        except Exception:
-            logging.exception("Error KeepALive, (need at least 4 bytes : {})".format(len(self.read_buffer)))
-            return False
+            for new_message in self.parser.messages():
+                if not self.healthy:
+                    break
 
-        self.read_buffer = self.read_buffer[keep_alive.total_length:]
-        return True
+                if isinstance(new_message, message.Handshake):
+                    self.has_handshaked = True
+                    logging.debug('handle_handshake - %s' % self.ip)
 
-    def get_messages(self):
-        while len(self.read_buffer) > 4 and self.healthy:
-            if (not self.has_handshaked and self._handle_handshake()) or self._handle_keep_alive():
-                continue
+                elif isinstance(new_message, message.KeepAlive):
+                    logging.debug('handle_keep_alive - %s' % self.ip)
 
-            payload_length, = struct.unpack(">I", self.read_buffer[:4])
-            total_length = payload_length + 4
+                else:
+                    yield new_message
 
-            if len(self.read_buffer) < total_length:
-                break
-            else:
-                payload = self.read_buffer[:total_length]
-                self.read_buffer = self.read_buffer[total_length:]
-
-            try:
-                received_message = message.MessageDispatcher(payload).dispatch()
-                if received_message:
-                    yield received_message
-            except message.WrongMessageException as e:
-                logging.exception(e.__str__())
+        except message.WrongMessageException as e:
+            logging.warning("Wrong message from peer %s : %s" % (self.ip, e.__str__()))
+            self.healthy = False
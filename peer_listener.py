@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from message import Handshake, WrongMessageException
+
+LISTEN_PORT = 6881
+HANDSHAKE_TIMEOUT = 10  # seconds for an incoming peer to send its handshake
+
+
+class PeerListener(object):
+    """
+        Accepts incoming peer connections on LISTEN_PORT, on the peer event loop.
+        The info hash of the incoming handshake picks the PeersManager of the torrent the peer wants.
+    """
+
+    def __init__(self, loop, port=LISTEN_PORT):
+        self.loop = loop
+        self.port = port
+        self.peers_managers = {}  # info_hash -> PeersManager
+        self.server = None
+
+    def add_torrent(self, peers_manager):
+        self.peers_managers[peers_manager.torrent.info_hash] = peers_manager
+
+    def remove_torrent(self, peers_manager):
+        self.peers_managers.pop(peers_manager.torrent.info_hash, None)
+
+    def get_peers_manager(self, info_hash):
+        return self.peers_managers.get(info_hash)
+
+    def start(self):
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop)
+
+    def stop(self):
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def _start(self):
+        try:
+            self.server = await self.loop.create_server(lambda: HandshakeProtocol(self), port=self.port,
+                                                        reuse_address=True)
+            logging.info("Listening for peers on port %d" % self.port)
+        except OSError as e:
+            logging.error("Can't listen on port %d, outgoing connections only : %s" % (self.port, e.__str__()))
+
+
+class HandshakeProtocol(asyncio.BufferedProtocol):
+    """
+        Reads the handshake of an incoming connection, then hands the transport over to the PeersManager
+        of the torrent, which switches it to a PeerProtocol. Nothing past the handshake is read here.
+        Connections that don't send their handshake within HANDSHAKE_TIMEOUT are closed.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.transport = None
+        self.handshake = bytearray(Handshake.total_length)
+        self.received = 0
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.timer = self.listener.loop.call_later(HANDSHAKE_TIMEOUT, transport.close)
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.handshake)[self.received:]
+
+    def buffer_updated(self, nbytes):
+        self.received += nbytes
+
+        if self.received < len(self.handshake):
+            return
+
+        self.timer.cancel()
+        ip, port = self.transport.get_extra_info('peername')[:2]
+
+        try:
+            handshake = Handshake.from_bytes(self.handshake)
+        except WrongMessageException:
+            logging.debug("Wrong handshake from incoming peer %s" % ip)
+            self.transport.close()
+            return
+
+        peers_manager = self.listener.get_peers_manager(handshake.info_hash)
+
+        if peers_manager is None:
+            logging.debug("Incoming peer %s asks for an unknown torrent" % ip)
+            self.transport.close()
+            return
+
+        peers_manager.peer_accepted(self.transport, ip, port)
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
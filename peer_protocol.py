@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from collections import deque
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+        One protocol instance per connected Peer, driven by the PeersManager event loop.
+        It owns the transport: handshake on connect, framing of incoming data, dispatch and writes.
+        Incoming bytes are received straight into the Peer's MessageParser buffer (recv_into), without copy.
+    """
+
+    def __init__(self, peers_manager, peer):
+        self.peers_manager = peers_manager
+        self.peer = peer
+        self.loop = peers_manager.loop
+        self.transport = None
+        self.uploads = deque()
+        self.sending_file = False
+        self.pending_writes = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer.protocol = self
+        self.peer.healthy = True
+        logging.debug("Connected to peer ip: {} - port: {}".format(self.peer.ip, self.peer.port))
+
+        self.peers_manager.peer_connected(self.peer)
+
+    def get_buffer(self, sizehint):
+        return self.peer.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.peer.parser.buffer_updated(nbytes)
+
+        for new_message in self.peer.get_messages():
+            self.peers_manager._process_new_message(new_message, self.peer)
+
+        if not self.peer.healthy:
+            self.close()
+
+    def connection_lost(self, exc):
+        if exc:
+            logging.debug("Connection lost with peer %s : %s" % (self.peer.ip, exc.__str__()))
+
+        self.peer.healthy = False
+        self.peers_manager.remove_peer(self.peer)
+
+    def write(self, data):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("Transport closed")
+
+        # Peer.send_to_peer is also called from the download thread
+        if self.peers_manager.event_loop.is_current():
+            self._write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._write_if_open, data)
+
+    def _write_if_open(self, data):
+        if self.transport and not self.transport.is_closing():
+            self._write(data)
+
+    def _write(self, data):
+        # The transport can't be written to while sendfile is in progress
+        if self.sending_file:
+            self.pending_writes.append(data)
+        else:
+            self.transport.write(data)
+
+    def send_file(self, header, segments):
+        """
+            Sends header, then the (path, file offset, length) segments straight from the files with sendfile.
+            Must be called from the event loop thread.
+        """
+        self.uploads.append((header, segments))
+
+        if not self.sending_file:
+            self.sending_file = True
+            self.loop.create_task(self._send_files())
+
+    async def _send_files(self):
+        storage = self.peers_manager.pieces_manager.storage
+
+        try:
+            while self.uploads and not self.transport.is_closing():
+                header, segments = self.uploads.popleft()
+                self.transport.write(header)
+
+                for path, file_offset, length in segments:
+                    file = storage.acquire_file(path)
+                    try:
+                        await self.loop.sendfile(self.transport, file, file_offset, length)
+                    finally:
+                        storage.release_file(path)
+
+                self._flush_pending_writes()
+
+        except Exception as e:
+            logging.error("Failed to send file to peer %s : %s" % (self.peer.ip, e.__str__()))
+            self.peer.healthy = False
+            self.close()
+
+        finally:
+            self.sending_file = False
+            self.uploads.clear()
+
+        self._flush_pending_writes()
+
+    def _flush_pending_writes(self):
+        pending_writes, self.pending_writes = self.pending_writes, []
+
+        if self.transport.is_closing():
+            return
+
+        for data in pending_writes:
+            self.transport.write(data)
+
+    def close(self):
+        if self.transport and not self.transport.is_closing():
+            self.transport.close()
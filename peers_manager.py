@@ -1,56 +1,347 @@
 import time
-import select
-from threading import Thread
+import asyncio
 from pubsub import pub
+from event_loop import EventLoopThread
 import rarest_piece
+from choker import Choker, CHOKE_INTERVAL
+from rate_meter import RateMeter
+import bandwidth
+from bandwidth import BandwidthLimits
+from block import BLOCK_SIZE
 import logging
 import message
 import peer
-import errno
-import socket
 import random
+from collections import deque
+from peer_protocol import PeerProtocol
+from message import MAX_REQUEST_LENGTH
+
+MAX_PEERS_CONNECTED = 8
+MAX_CONNECTING_PEERS = 16  # connection attempts raced in parallel
+PEER_CONNECT_TIMEOUT = 2
+NOT_INTERESTED_TIMEOUT = 30  # seconds before dropping a peer when neither side is interested
+MAX_QUEUED_UPLOADS = 256  # per peer
+
+
+class ConnectionBudget(object):
+    """
+        Peer connections shared by the torrents of a Session, on top of the limits of each torrent:
+        connected peers and connection attempts in progress. Freed connections are offered to the
+        torrents in turn. Only used from the event loop thread.
+    """
+
+    def __init__(self, max_peers=MAX_PEERS_CONNECTED, max_connecting=MAX_CONNECTING_PEERS):
+        self.max_peers = max_peers
+        self.max_connecting = max_connecting
+        self.connected = 0
+        self.connecting = 0
+        self.peers_managers = deque()
+
+    def add(self, peers_manager):
+        self.peers_managers.append(peers_manager)
+
+    def remove(self, peers_manager):
+        if peers_manager in self.peers_managers:
+            self.peers_managers.remove(peers_manager)
+
+    def is_full(self):
+        return self.connected >= self.max_peers
+
+    def can_dial(self):
+        return self.connecting < self.max_connecting and not self.is_full()
+
+    def dial(self):
+        """
+            Starts connection attempts while the budget allows, one per torrent in turn
+        """
+        dialed = True
+
+        while dialed and self.can_dial():
+            dialed = False
+
+            for _ in range(len(self.peers_managers)):
+                if not self.can_dial():
+                    break
+
+                peers_manager = self.peers_managers[0]
+                self.peers_managers.rotate(-1)
+                dialed = peers_manager._dial_one() or dialed
 
 
-class PeersManager(Thread):
-    def __init__(self, torrent, pieces_manager):
-        Thread.__init__(self)
+class PeersManager(object):
+    def __init__(self, torrent, pieces_manager, global_limits=None, event_loop=None, budget=None):
         self.peers = []
         self.torrent = torrent
         self.pieces_manager = pieces_manager
         self.rarest_pieces = rarest_piece.RarestPieces(pieces_manager)
-        self.pieces_by_peer = [[0, []] for _ in range(pieces_manager.number_of_pieces)]
+        self.choker = Choker(self)
         self.is_active = True
+        self.endgame = False
+        self.candidates = deque()  # (ip, port) from the trackers not dialed yet, the Peer is built when dialed
+        self.connecting = {}  # peer -> connection attempt task
+        self.uploaded_length = 0
+        self.download_meter = RateMeter()  # whole torrent, each peer has its own meters too
+        self.upload_meter = RateMeter()
+        self.global_limits = global_limits or bandwidth.global_limits
+        self.limits = BandwidthLimits()  # this torrent's
+        self.upload_queue = deque()  # peers with requests waiting for upload bandwidth, served in turn
+        self.upload_timer = None
+        self.choke_timer = None
+        self.event_loop = event_loop or EventLoopThread()
+        self.own_event_loop = event_loop is None
+        self.loop = self.event_loop.loop
+        self.budget = budget or ConnectionBudget()
 
         # Events
-        pub.subscribe(self.peer_requests_piece, 'PeersManager.PeerRequestsPiece')
-        pub.subscribe(self.peers_bitfield, 'PeersManager.updatePeersBitfield')
+        pub.subscribe(self.peer_requests_piece, torrent.topic('PeersManager.PeerRequestsPiece'))
+        pub.subscribe(self.piece_completed, torrent.topic('PiecesManager.PieceCompleted'))
 
     def peer_requests_piece(self, request=None, peer=None):
         if not request or not peer:
             logging.error("empty request/peer message")
+            return
+
+        piece_index, block_offset, block_length = request.piece_index, request.block_offset, request.block_length
+
+        if block_length > MAX_REQUEST_LENGTH:
+            logging.warning("Request too long (%d bytes) from peer : %s" % (block_length, peer.ip))
+            return
+
+        if not self.pieces_manager.has_block(piece_index, block_offset, block_length):
+            logging.warning("Request for a block we don't have (piece %d, offset %d, length %d) from peer : %s"
+                            % (piece_index, block_offset, block_length, peer.ip))
+            return
+
+        if len(peer.upload_requests) >= MAX_QUEUED_UPLOADS:
+            logging.warning("Too many queued requests from peer : %s" % peer.ip)
+            return
+
+        if not peer.upload_requests:
+            self.upload_queue.append(peer)
+        peer.upload_requests.append(request)
+
+        self._serve_uploads()
+
+    def set_limits(self, upload_rate=None, download_rate=None):
+        """
+            Bandwidth limits of this torrent in bytes per second, 0 for unlimited. Can be called from any thread.
+        """
+        self.limits.set_limits(upload_rate, download_rate)
+        self.loop.call_soon_threadsafe(self._serve_uploads)
+
+    def _upload_buckets(self, peer):
+        return peer.limits.upload, self.limits.upload, self.global_limits.upload
+
+    def _download_buckets(self, peer):
+        return peer.limits.download, self.limits.download, self.global_limits.download
+
+    def _serve_uploads(self):
+        """
+            Sends the queued blocks as the upload bandwidth allows, one block per peer in turn so that
+            peers share it evenly. Waits for the buckets to refill when no peer can send.
+        """
+        if self.upload_timer is not None:
+            self.upload_timer.cancel()
+            self.upload_timer = None
+
+        wait = None
+        blocked_peers = 0
+
+        while self.upload_queue and blocked_peers < len(self.upload_queue):
+            peer = self.upload_queue.popleft()
+
+            if not peer.healthy or not peer.upload_requests:
+                peer.upload_requests.clear()
+                continue
+
+            request = peer.upload_requests[0]
+            buckets = self._upload_buckets(peer)
+
+            if bandwidth.try_consume(buckets, request.block_length):
+                peer.upload_requests.popleft()
+                self._send_block(peer, request)
+                blocked_peers = 0
+            else:
+                blocked_peers += 1
+                peer_wait = bandwidth.delay(buckets, request.block_length)
+                wait = peer_wait if wait is None else min(wait, peer_wait)
+
+            if peer.upload_requests:
+                self.upload_queue.append(peer)
+
+        if self.upload_queue and wait is not None:
+            self.upload_timer = self.loop.call_later(wait, self._serve_uploads)
 
+    def _send_block(self, peer, request):
         piece_index, block_offset, block_length = request.piece_index, request.block_offset, request.block_length
+        header = message.Piece(block_length, piece_index, block_offset, None).header_to_bytes()
+        segments = self.pieces_manager.get_block_segments(piece_index, block_offset, block_length)
+
+        # On disk: only the header goes through Python, the block is sent from the file with sendfile
+        if segments:
+            if sum(length for _, _, length in segments) == block_length:
+                peer.send_file_to_peer(header, segments)
+                self._block_uploaded(peer, block_length)
+                logging.info("Sent piece index {} to peer : {}".format(request.piece_index, peer.ip))
+            return
 
         block = self.pieces_manager.get_block(piece_index, block_offset, block_length)
-        if block:
-            piece = message.Piece(piece_index, block_offset, block_length, block).to_bytes()
-            peer.send_to_peer(piece)
+        if block is not None and len(block) == block_length:
+            peer.send_to_peer(header)
+            peer.send_to_peer(block)
+            self._block_uploaded(peer, block_length)
             logging.info("Sent piece index {} to peer : {}".format(request.piece_index, peer.ip))
 
-    def peers_bitfield(self, bitfield=None):
-        for i in range(len(self.pieces_by_peer)):
-            if bitfield[i] == 1 and peer not in self.pieces_by_peer[i][1] and self.pieces_by_peer[i][0]:
-                self.pieces_by_peer[i][1].append(peer)
-                self.pieces_by_peer[i][0] = len(self.pieces_by_peer[i][1])
+    def _block_uploaded(self, peer, block_length):
+        peer.upload_meter.add(block_length)
+        self.upload_meter.add(block_length)
+        self.uploaded_length += block_length
+
+    def piece_completed(self, piece_index):
+        self.rarest_pieces.piece_completed(piece_index)
+
+        have = message.Have(piece_index).to_bytes()
+        for connected_peer in self.peers:
+            connected_peer.send_to_peer(have)
+
+        for peer in self.rarest_pieces.get_peers_having_piece(piece_index):
+            self._update_interest(peer)
+
+    def _update_interest(self, peer):
+        """
+            Interested while the peer has a piece we need, NotInterested otherwise
+        """
+        peer.set_interested(self.rarest_pieces.is_interesting(peer))
+
+    def schedule_requests(self):
+        self.loop.call_soon_threadsafe(self._refill_requests)
 
-    def get_random_peer_having_piece(self, index):
-        ready_peers = []
+    def _refill_requests(self):
+        self.pieces_manager.update_block_status()
+
+        all_blocks_requested = self.pieces_manager.all_blocks_requested()
+        if all_blocks_requested != self.endgame:
+            logging.info("Entering endgame mode" if all_blocks_requested else "Leaving endgame mode")
+            self.endgame = all_blocks_requested
 
         for peer in self.peers:
-            if peer.is_eligible() and peer.is_unchoked() and peer.am_interested() and peer.has_piece(index):
-                ready_peers.append(peer)
+            peer.expire_requests()
+
+        if self._is_download_limited():
+            self._share_download_bandwidth()
+        else:
+            for peer in self.peers:
+                self.request_blocks(peer)
+
+    def _is_download_limited(self):
+        return self.limits.download.is_limited() or self.global_limits.download.is_limited()
+
+    def _share_download_bandwidth(self):
+        """
+            Under a global or torrent download limit, requests one block per peer in turn while the bandwidth
+            allows, so the peers that happen to come first do not take it all
+        """
+        peers = list(self.peers)
+        random.shuffle(peers)
+
+        while peers:
+            peers = [peer for peer in peers if self.request_blocks(peer, max_requests=1)]
+
+    def request_blocks(self, peer, max_requests=None):
+        """
+            Tops up the peer's pipeline of outstanding block requests, within the download bandwidth
+            :return: the number of bytes requested
+        """
+        if not peer.healthy or not peer.is_unchoked() or not peer.am_interested():
+            return 0
+
+        slots = peer.request_slots()
+        if max_requests is not None:
+            slots = min(slots, max_requests)
+
+        buckets = self._download_buckets(peer)
+        allowed_requests = bandwidth.allowance(buckets, BLOCK_SIZE)
+        if allowed_requests is not None:
+            slots = min(slots, allowed_requests)
+
+        requested_length = 0
+
+        for piece_index in self.rarest_pieces.get_sorted_pieces(peer):
+            if slots <= 0:
+                break
+
+            piece = self.pieces_manager.get_piece(piece_index)
+            if piece is None or piece.is_full or piece.is_verifying:
+                continue
+
+            while slots > 0:
+                data = piece.get_empty_block()
+                if not data:
+                    break
+
+                peer.send_request(*data)
+                requested_length += data[2]
+                slots -= 1
+
+        if self.endgame and slots > 0:
+            requested_length += self._request_endgame_blocks(peer, slots)
 
-        return random.choice(ready_peers) if ready_peers else None
+        bandwidth.consume(buckets, requested_length)
+
+        return requested_length
+
+    def _request_endgame_blocks(self, peer, slots):
+        """
+            Endgame: every remaining block is already requested, so ask this peer too for the
+            pending blocks it has. Duplicates are cancelled when the first copy arrives.
+        """
+        requested_length = 0
+
+        for piece_index in self.rarest_pieces.get_sorted_pieces(peer):
+            if slots <= 0:
+                break
+
+            piece = self.pieces_manager.pieces.get(piece_index)
+            if piece is None:
+                continue
+
+            for _, block_offset, block_length in piece.get_pending_blocks():
+                if slots <= 0:
+                    break
+
+                if (piece_index, block_offset) in peer.outstanding_requests:
+                    continue
+
+                peer.send_request(piece_index, block_offset, block_length)
+                requested_length += block_length
+                slots -= 1
+
+        return requested_length
+
+    def _cancel_duplicate_requests(self, piece_message, peer):
+        key = (piece_message.piece_index, piece_message.block_offset)
+
+        for other_peer in self.peers:
+            if other_peer is not peer and key in other_peer.outstanding_requests:
+                other_peer.send_cancel(piece_message.piece_index, piece_message.block_offset,
+                                       piece_message.block_length)
+
+    def _release_requests(self, peer):
+        """
+            Frees the blocks requested from the peer, except in endgame those another peer has pending too
+        """
+        other_peers = [other_peer for other_peer in self.peers if other_peer is not peer] if self.endgame else []
+
+        for piece_index, block_offset in peer.clear_requests():
+            if not any(other_peer.has_request(piece_index, block_offset) for other_peer in other_peers):
+                self.pieces_manager.release_block(piece_index, block_offset)
+
+    def needs_peers(self):
+        """
+            True when every candidate has been tried and there are free peer slots
+        """
+        return not self.candidates and not self.connecting and len(self.peers) < MAX_PEERS_CONNECTED and \
+            not self.budget.is_full()
 
     def has_unchoked_peers(self):
         for peer in self.peers:
@@ -65,56 +356,64 @@ class PeersManager(Thread):
                 cpt += 1
         return cpt
 
+    def _drop_idle_peers(self):
+        """
+            Also runs while seeding, so that finished torrents hand their connections over to the other
+            torrents of the session
+        """
+        now = time.time()
 
-    @staticmethod
-    def _read_from_socket(sock):
-        data = b''
+        for peer in list(self.peers):
+            if not peer.am_interested() and not peer.is_interested() and \
+                    now - peer.connected_at > NOT_INTERESTED_TIMEOUT:
+                logging.info("Dropping peer %s : no interest on either side" % peer.ip)
+                self.remove_peer(peer)
 
-        while True:
-            try:
-                buff = sock.recv(4096)
-                if len(buff) <= 0:
-                    break
+    def _choke_round(self):
+        self._drop_idle_peers()
+        self.choker.run_round()
+        self.choke_timer = self.loop.call_later(CHOKE_INTERVAL, self._choke_round)
 
-                data += buff
-            except socket.error as e:
-                err = e.args[0]
-                if err != errno.EAGAIN or err != errno.EWOULDBLOCK:
-                    logging.debug("Wrong errno {}".format(err))
-                break
-            except Exception:
-                logging.exception("Recv failed")
-                break
+    def start(self):
+        if self.own_event_loop:
+            self.event_loop.start()
 
-        return data
+        self.loop.call_soon_threadsafe(self._start)
 
-    def run(self):
-        while self.is_active:
-            read = [peer.socket for peer in self.peers]
-            read_list, _, _ = select.select(read, [], [], 1)
+    def _start(self):
+        self.budget.add(self)
+        self._choke_round()
 
-            for socket in read_list:
-                peer = self.get_peer_by_socket(socket)
-                if not peer.healthy:
-                    self.remove_peer(peer)
-                    continue
+    def stop(self):
+        """
+            Disconnects the peers of this torrent, and stops the event loop if it is not shared
+        """
+        self.is_active = False
+        self.loop.call_soon_threadsafe(self._close)
 
-                try:
-                    payload = self._read_from_socket(socket)
-                except Exception as e:
-                    logging.error("Recv failed %s" % e.__str__())
-                    self.remove_peer(peer)
-                    continue
+        if self.own_event_loop:
+            self.event_loop.stop()
 
-                peer.read_buffer += payload
+    def _close(self):
+        self.budget.remove(self)
 
-                for message in peer.get_messages():
-                    self._process_new_message(message, peer)
+        for timer in (self.choke_timer, self.upload_timer):
+            if timer is not None:
+                timer.cancel()
+
+        for task in list(self.connecting.values()):
+            task.cancel()
+
+        for peer in list(self.peers):
+            self.remove_peer(peer)
 
     def _do_handshake(self, peer):
         try:
             handshake = message.Handshake(self.torrent.info_hash)
             peer.send_to_peer(handshake.to_bytes())
+
+            if self.pieces_manager.complete_pieces:
+                peer.send_to_peer(message.BitField(self.pieces_manager.bitfield).to_bytes())
             logging.info("new peer added : %s" % peer.ip)
             return True
 
@@ -123,32 +422,111 @@ class PeersManager(Thread):
 
         return False
 
-    def add_peers(self, peers):
-        for peer in peers:
-            if self._do_handshake(peer):
-                self.peers.append(peer)
-            else:
-                print("Error _do_handshake")
+    def add_peers(self, sock_addrs):
+        addresses = [(sock_addr.ip, sock_addr.port) for sock_addr in sock_addrs]
+        self.loop.call_soon_threadsafe(self._add_candidates, addresses)
+
+    def _new_peer(self, ip, port):
+        return peer.Peer(self.torrent, self.pieces_manager.number_of_pieces, ip, port)
+
+    def _add_candidates(self, addresses):
+        """
+            Queues the addresses that are not connected, being dialed or queued already
+        """
+        known_addresses = set(self.candidates)
+        known_addresses.update((p.ip, p.port) for p in self.peers)
+        known_addresses.update((p.ip, p.port) for p in self.connecting)
+
+        new_addresses = [address for address in dict.fromkeys(addresses) if address not in known_addresses]
+        logging.info("Got %d new candidate peer(s)" % len(new_addresses))
+        self.candidates.extend(new_addresses)
+        self._dial()
+
+    def _dial(self):
+        """
+            Races up to MAX_CONNECTING_PEERS connection attempts while there are free peer slots, within
+            the connection budget shared with the other torrents. The first ones to succeed take the slots,
+            the others are cancelled once they are all taken.
+        """
+        self.budget.dial()
+
+    def _dial_one(self):
+        if not self.is_active or not self.candidates or len(self.connecting) >= MAX_CONNECTING_PEERS or \
+                len(self.peers) >= MAX_PEERS_CONNECTED:
+            return False
+
+        new_peer = self._new_peer(*self.candidates.popleft())
+        task = self.loop.create_task(self._connect_peer(new_peer))
+        task.add_done_callback(lambda t, p=new_peer: self._connect_done(p, t))
+        self.connecting[new_peer] = task
+        self.budget.connecting += 1
+
+        return True
+
+    def _connect_done(self, peer, task):
+        self.connecting.pop(peer, None)
+        self.budget.connecting -= 1
+
+        if task.cancelled() and self.is_active:
+            self.candidates.append((peer.ip, peer.port))  # not tried until the end: dialed again when a slot frees
+
+        if len(self.peers) >= MAX_PEERS_CONNECTED or self.budget.is_full():
+            for pending_task in list(self.connecting.values()):
+                pending_task.cancel()
+        else:
+            self._dial()
+
+    async def _connect_peer(self, new_peer):
+        try:
+            await asyncio.wait_for(
+                self.loop.create_connection(lambda: PeerProtocol(self, new_peer), new_peer.ip, new_peer.port),
+                timeout=PEER_CONNECT_TIMEOUT)
+        except Exception as e:
+            logging.debug("Failed to connect to peer (ip: %s - port: %s - %s)" % (new_peer.ip, new_peer.port,
+                                                                                 e.__str__()))
+            return False
+
+        return True
+
+    def peer_accepted(self, transport, ip, port):
+        """
+            Incoming connection whose handshake has been read by the PeerListener
+        """
+        new_peer = self._new_peer(ip, port)
+        new_peer.has_handshaked = True
+        new_peer.parser.has_handshaked = True
+
+        protocol = PeerProtocol(self, new_peer)
+        transport.set_protocol(protocol)
+        protocol.connection_made(transport)
+
+    def peer_connected(self, peer):
+        if len(self.peers) >= MAX_PEERS_CONNECTED or self.budget.is_full() or not self.is_active:
+            peer.protocol.close()  # lost the race for the last slot
+
+            if self.is_active and peer in self.connecting and len(self.peers) < MAX_PEERS_CONNECTED:
+                self.candidates.append((peer.ip, peer.port))  # taken by another torrent, retried later
+
+        elif self._do_handshake(peer):
+            peer.connected_at = time.time()
+            self.peers.append(peer)
+            self.budget.connected += 1
+            logging.info("Connected to %d/%d peers" % (len(self.peers), MAX_PEERS_CONNECTED))
+        else:
+            peer.protocol.close()
 
     def remove_peer(self, peer):
         if peer in self.peers:
             try:
-                peer.socket.close()
+                peer.protocol.close()
             except Exception:
                 logging.exception("")
 
             self.peers.remove(peer)
-
-        #for rarest_piece in self.rarest_pieces.rarest_pieces:
-        #    if peer in rarest_piece["peers"]:
-        #        rarest_piece["peers"].remove(peer)
-
-    def get_peer_by_socket(self, socket):
-        for peer in self.peers:
-            if socket == peer.socket:
-                return peer
-
-        raise Exception("Peer not present in peer_list")
+            self.budget.connected -= 1
+            self._release_requests(peer)
+            pub.sendMessage(self.torrent.topic('RarestPiece.peerDisconnected'), peer=peer)
+            self._dial()
 
     def _process_new_message(self, new_message: message.Message, peer: peer.Peer):
         if isinstance(new_message, message.Handshake) or isinstance(new_message, message.KeepAlive):
@@ -156,30 +534,40 @@ class PeersManager(Thread):
 
         elif isinstance(new_message, message.Choke):
             peer.handle_choke()
+            self._release_requests(peer)
 
         elif isinstance(new_message, message.UnChoke):
             peer.handle_unchoke()
+            self.request_blocks(peer)
 
         elif isinstance(new_message, message.Interested):
             peer.handle_interested()
+            self.choker.peer_interested(peer)
 
         elif isinstance(new_message, message.NotInterested):
             peer.handle_not_interested()
 
         elif isinstance(new_message, message.Have):
             peer.handle_have(new_message)
+            self._update_interest(peer)
 
         elif isinstance(new_message, message.BitField):
             peer.handle_bitfield(new_message)
+            self._update_interest(peer)
 
         elif isinstance(new_message, message.Request):
             peer.handle_request(new_message)
 
         elif isinstance(new_message, message.Piece):
+            self.download_meter.add(len(new_message.block))
             peer.handle_piece(new_message)
+            if self.endgame:
+                self._cancel_duplicate_requests(new_message, peer)
+            if not self._is_download_limited():  # otherwise shared out by _refill_requests
+                self.request_blocks(peer)
 
         elif isinstance(new_message, message.Cancel):
-            peer.handle_cancel()
+            peer.handle_cancel(new_message)
 
         elif isinstance(new_message, message.Port):
             peer.handle_port_request()
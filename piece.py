@@ -1,116 +1,188 @@
 import hashlib
 import math
-import time
 import logging
 
-from pubsub import pub
-from block import Block, BLOCK_SIZE, State
+from block import BLOCK_SIZE, BLOCK_REQUEST_TIMEOUT, State
+from verifier import finish_digest
 
 
 class Piece(object):
-    def __init__(self, piece_index: int, piece_size: int, piece_hash: str):
+    """
+        A piece being downloaded, verified or written. Its block states live in the torrent's BlockStates,
+        from block first_block to first_block + number_of_blocks.
+    """
+
+    def __init__(self, piece_index: int, piece_size: int, piece_hash: str, block_states, files,
+                 incremental_hash: bool = True):
         self.piece_index: int = piece_index
         self.piece_size: int = piece_size
         self.piece_hash: str = piece_hash
         self.is_full: bool = False
-        self.files = []
-        self.raw_data: bytes = b''
+        self.is_verifying: bool = False
+        self.incremental_hash: bool = incremental_hash
+        self.files = files
+        self.raw_data: bytearray = None  # allocated when the first block arrives, blocks are written in place
         self.number_of_blocks: int = int(math.ceil(float(piece_size) / BLOCK_SIZE))
-        self.blocks: list[Block] = []
+        self.block_states = block_states
+        self.first_block: int = block_states.first_block(piece_index)
+        self.end_block: int = self.first_block + self.number_of_blocks
+        self.hasher = None  # running SHA-1 of the contiguous full blocks at the front of the piece
+        self.hashed_blocks: int = 0
+        self.hashing_blocks: int = 0  # hashed_blocks once the running hash update is done
+        self.is_hashing: bool = False
 
         self._init_blocks()
 
+    def block_size(self, block_index):
+        if block_index == self.number_of_blocks - 1:
+            return self.piece_size - block_index * BLOCK_SIZE
+
+        return BLOCK_SIZE
+
     def update_block_status(self):  # if block is pending for too long : set it free
-        for i, block in enumerate(self.blocks):
-            if block.state == State.PENDING and (time.time() - block.last_seen) > 5:
-                self.blocks[i] = Block()
+        states, last_seen = self.block_states.states, self.block_states.last_seen
+        now = self.block_states.now()
+
+        index = states.find(State.PENDING, self.first_block, self.end_block)
+        while index != -1:
+            if now - last_seen[index] > BLOCK_REQUEST_TIMEOUT:
+                states[index] = State.FREE
+            index = states.find(State.PENDING, index + 1, self.end_block)
 
     def set_block(self, offset, data):
-        index = int(offset / BLOCK_SIZE)
+        if offset < 0 or offset % BLOCK_SIZE != 0 or offset + len(data) > self.piece_size:
+            logging.warning("Wrong block offset for piece %d : %d" % (self.piece_index, offset))
+            return False
+
+        block_index = offset // BLOCK_SIZE
+
+        states = self.block_states.states
+
+        if not self.is_full and not states[self.first_block + block_index] == State.FULL:
+            if len(data) != self.block_size(block_index):
+                logging.warning("Wrong block size for piece %d offset %d : %d" % (self.piece_index, offset, len(data)))
+                return False
+
+            if self.raw_data is None:
+                self.raw_data = bytearray(self.piece_size)
 
-        if not self.is_full and not self.blocks[index].state == State.FULL:
-            self.blocks[index].data = data
-            self.blocks[index].state = State.FULL
+            # data may be a view of a peer receive buffer, this is the only copy of it
+            memoryview(self.raw_data)[offset:offset + len(data)] = data
+            states[self.first_block + block_index] = State.FULL
+
+            return True
+
+        return False
 
     def get_block(self, block_offset, block_length):
-        return self.raw_data[block_offset:block_length]
+        raw_data = self.raw_data  # released from the DiskWriter thread
+        if raw_data is None:
+            return None
+
+        return memoryview(raw_data)[block_offset:block_offset + block_length]
+
+    def release_data(self):  # written on disk, blocks are now read back from the storage
+        self.raw_data = None
 
     def get_empty_block(self):
         if self.is_full:
             return None
 
-        for block_index, block in enumerate(self.blocks):
-            if block.state == State.FREE:
-                self.blocks[block_index].state = State.PENDING
-                self.blocks[block_index].last_seen = time.time()
-                return self.piece_index, block_index * BLOCK_SIZE, block.block_size
+        index = self.block_states.states.find(State.FREE, self.first_block, self.end_block)
+        if index == -1:
+            return None
+
+        self.block_states.states[index] = State.PENDING
+        self.block_states.last_seen[index] = self.block_states.now()
+        block_index = index - self.first_block
 
-        return None
+        return self.piece_index, block_index * BLOCK_SIZE, self.block_size(block_index)
+
+    def get_pending_blocks(self):
+        states = self.block_states.states
+
+        index = states.find(State.PENDING, self.first_block, self.end_block)
+        while index != -1:
+            block_index = index - self.first_block
+            yield self.piece_index, block_index * BLOCK_SIZE, self.block_size(block_index)
+            index = states.find(State.PENDING, index + 1, self.end_block)
+
+    def has_free_blocks(self):
+        return self.block_states.states.find(State.FREE, self.first_block, self.end_block) != -1
 
     def are_all_blocks_full(self):
-        for block in self.blocks:
-            if block.state == State.FREE or block.state == State.PENDING:
-                return False
+        return self.block_states.states.count(State.FULL, self.first_block, self.end_block) == self.number_of_blocks
+
+    def get_hash_update(self):
+        """
+            Function and arguments adding the contiguous full blocks not hashed yet to the running hash, None if
+            there are none or an update is already running. Meant to run off the network thread, one at a time:
+            hash_update_done() must be called once it has run.
+            Out of order blocks wait in raw_data until the gap before them is filled.
+        """
+        if not self.incremental_hash or self.is_hashing:
+            return None
 
-        return True
+        states = self.block_states.states
+        end = self.hashed_blocks
+        while end < self.number_of_blocks and states[self.first_block + end] == State.FULL:
+            end += 1
+
+        if end == self.hashed_blocks:
+            return None
+
+        self.is_hashing = True
+        self.hashing_blocks = end
+        start_offset, end_offset = self.hashed_blocks * BLOCK_SIZE, min(end * BLOCK_SIZE, self.piece_size)
+
+        return self.hasher.update, (memoryview(self.raw_data)[start_offset:end_offset],)
 
-    def set_to_full(self):
-        data = self._merge_blocks()
+    def hash_update_done(self, failed=False):
+        self.is_hashing = False
 
-        if not self._valid_blocks(data):
+        if failed:
+            self.hasher = hashlib.sha1()
+            self.hashed_blocks = 0
+        else:
+            self.hashed_blocks = self.hashing_blocks
+
+    def get_hash_job(self):
+        """
+            Function and arguments finishing the running hash over the blocks not hashed yet.
+            Meant to run off the network thread, once all blocks are full and no hash update is running.
+        """
+        if not self.incremental_hash:
+            self.hasher = hashlib.sha1()
+            self.hashed_blocks = 0
+
+        offset = self.hashed_blocks * BLOCK_SIZE
+        return finish_digest, (self.hasher, memoryview(self.raw_data)[offset:])
+
+    def set_to_full(self, piece_digest):
+        if not self._valid_blocks(piece_digest):
             self._init_blocks()
             return False
 
         self.is_full = True
-        self.raw_data = data
-        self._write_piece_on_disk()
-        pub.sendMessage('PiecesManager.PieceCompleted', piece_index=self.piece_index)
 
         return True
 
     def _init_blocks(self):
-        self.blocks = []
-
-        if self.number_of_blocks > 1:
-            for i in range(self.number_of_blocks):
-                self.blocks.append(Block())
+        self.block_states.states[self.first_block:self.end_block] = bytes(self.number_of_blocks)
+        self.hasher = hashlib.sha1()
+        self.hashed_blocks = 0
 
-            # Last block of last piece, the special block
-            if (self.piece_size % BLOCK_SIZE) > 0:
-                self.blocks[self.number_of_blocks - 1].block_size = self.piece_size % BLOCK_SIZE
+    def get_file_segments(self):
+        """
+            (path, file offset, data) of every file segment of this piece, for the DiskWriter
+        """
+        view = memoryview(self.raw_data)
 
-        else:
-            self.blocks.append(Block(block_size=int(self.piece_size)))
-
-    def _write_piece_on_disk(self):
         for file in self.files:
-            path_file = file["path"]
-            file_offset = file["fileOffset"]
             piece_offset = file["pieceOffset"]
-            length = file["length"]
-
-            try:
-                f = open(path_file, 'r+b')  # Already existing file
-            except IOError:
-                f = open(path_file, 'wb')  # New file
-            except Exception:
-                logging.exception("Can't write to file")
-                return
-
-            f.seek(file_offset)
-            f.write(self.raw_data[piece_offset:piece_offset + length])
-            f.close()
-
-    def _merge_blocks(self):
-        buf = b''
-
-        for block in self.blocks:
-            buf += block.data
-
-        return buf
+            yield file["path"], file["fileOffset"], view[piece_offset:piece_offset + file["length"]]
 
-    def _valid_blocks(self, piece_raw_data):
-        hashed_piece_raw_data = hashlib.sha1(piece_raw_data).digest()
+    def _valid_blocks(self, hashed_piece_raw_data):
 
         if hashed_piece_raw_data == self.piece_hash:
             return True
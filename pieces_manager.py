@@ -1,111 +1,177 @@
 import piece
 import bitstring
 import logging
+from bisect import bisect_right
 from pubsub import pub
+from verifier import PieceVerifier
+from disk_writer import DiskWriter
+from storage import MmapStorage
+from block import BlockStates
 
 
 class PiecesManager(object):
-    def __init__(self, torrent):
+    def __init__(self, torrent, verifier=None, disk_writer=None, storage=None):
         self.torrent = torrent
+        self.verifier = verifier or PieceVerifier()
+        self.disk_writer = disk_writer
+
+        if self.disk_writer is None:
+            self.disk_writer = DiskWriter()
+            self.disk_writer.start()
+
+        self.storage = storage or MmapStorage(torrent, self.disk_writer)
         self.number_of_pieces = int(torrent.number_of_pieces)
         self.bitfield = bitstring.BitArray(self.number_of_pieces)
-        self.pieces = self._generate_pieces()
-        self.files = self._load_files()
+        self.block_states = BlockStates(self.number_of_pieces, torrent.piece_length, torrent.total_length)
+        self.pieces = {}  # Piece objects only for the pieces being downloaded, verified or written
+        self.file_starts = self._load_file_starts()
         self.complete_pieces = 0
-
-        for file in self.files:
-            id_piece = file['idPiece']
-            self.pieces[id_piece].files.append(file)
+        self.downloaded_length = 0
+        self.completed_length = 0  # verified pieces
 
         # events
-        pub.subscribe(self.receive_block_piece, 'PiecesManager.Piece')
-        pub.subscribe(self.update_bitfield, 'PiecesManager.PieceCompleted')
+        pub.subscribe(self.receive_block_piece, torrent.topic('PiecesManager.Piece'))
+        pub.subscribe(self.update_bitfield, torrent.topic('PiecesManager.PieceCompleted'))
 
     def update_bitfield(self, piece_index):
         self.bitfield[piece_index] = 1
 
+    def get_piece(self, piece_index):
+        """
+            Piece being downloaded, created on first use. None once the piece is verified and written.
+        """
+        requested_piece = self.pieces.get(piece_index)
+
+        if requested_piece is None and not self.bitfield[piece_index]:
+            requested_piece = self._generate_piece(piece_index)
+            self.pieces[piece_index] = requested_piece
+
+        return requested_piece
+
     def receive_block_piece(self, piece):
         piece_index, piece_offset, piece_data = piece
 
-        if self.pieces[piece_index].is_full:
+        received_piece = self.pieces.get(piece_index)  # only pieces we requested blocks of
+        if received_piece is None or received_piece.is_full or received_piece.is_verifying:
             return
 
-        self.pieces[piece_index].set_block(piece_offset, piece_data)
+        if received_piece.set_block(piece_offset, piece_data):
+            self.downloaded_length += len(piece_data)
+
+        if received_piece.are_all_blocks_full():
+            received_piece.is_verifying = True
+            self.verifier.verify(received_piece, self.piece_verified)
+        else:
+            self.verifier.update(received_piece)
+
+    def piece_verified(self, verified_piece, piece_digest):
+        verified_piece.is_verifying = False
+
+        if verified_piece.set_to_full(piece_digest):
+            pub.sendMessage(self.torrent.topic('PiecesManager.PieceCompleted'), piece_index=verified_piece.piece_index)
+            self.storage.write_piece(verified_piece)
+            self.complete_pieces += 1
+            self.completed_length += verified_piece.piece_size
+        else:
+            self.downloaded_length -= verified_piece.piece_size
+
+    def update_block_status(self):
+        for piece_index, active_piece in list(self.pieces.items()):
+            if active_piece.is_full:
+                # Written on disk: drop the piece, blocks are now read back from the storage
+                if active_piece.raw_data is None:
+                    del self.pieces[piece_index]
+            else:
+                active_piece.update_block_status()
+
+    def release_block(self, piece_index, block_offset):
+        self.block_states.release(piece_index, block_offset)
 
-        if self.pieces[piece_index].are_all_blocks_full():
-            if self.pieces[piece_index].set_to_full():
-                self.complete_pieces +=1
+    def has_block(self, piece_index, block_offset, block_length):
+        """
+            True if the block lies within a verified piece, so that it can be uploaded
+        """
+        if not 0 <= piece_index < self.number_of_pieces or not self.bitfield[piece_index]:
+            return False
 
+        return 0 <= block_offset and 0 < block_length and block_offset + block_length <= self._piece_size(piece_index)
 
     def get_block(self, piece_index, block_offset, block_length):
-        for piece in self.pieces:
-            if piece_index == piece.piece_index:
-                if piece.is_full:
-                    return piece.get_block(block_offset, block_length)
-                else:
-                    break
+        if not 0 <= piece_index < self.number_of_pieces or not self.bitfield[piece_index]:
+            return None
+
+        requested_piece = self.pieces.get(piece_index)
+        block = requested_piece.get_block(block_offset, block_length) if requested_piece else None
+
+        if block is None:
+            block = self.storage.read(self._load_files(piece_index), block_offset, block_length)
 
-        return None
+        return block
+
+    def get_block_segments(self, piece_index, block_offset, block_length):
+        """
+            File segments (path, file offset, length) of a block of a verified piece already written on disk,
+            None if the piece is not on disk yet.
+        """
+        if not 0 <= piece_index < self.number_of_pieces or not self.bitfield[piece_index]:
+            return None
+
+        requested_piece = self.pieces.get(piece_index)
+        if requested_piece is not None and requested_piece.raw_data is not None:
+            return None
+
+        return list(self.storage.locate(self._load_files(piece_index), block_offset, block_length))
+
+    def all_blocks_requested(self):
+        return not self.block_states.has_free_blocks()
 
     def all_pieces_completed(self):
-        for piece in self.pieces:
-            if not piece.is_full:
-                return False
+        return self.complete_pieces == self.number_of_pieces
 
-        return True
+    def _piece_size(self, piece_index):
+        if piece_index == self.number_of_pieces - 1:
+            return self.torrent.total_length - (self.number_of_pieces - 1) * self.torrent.piece_length
 
-    def _generate_pieces(self):
-        pieces = []
-        last_piece = self.number_of_pieces - 1
+        return self.torrent.piece_length
 
-        for i in range(self.number_of_pieces):
-            start = i * 20
-            end = start + 20
+    def _generate_piece(self, piece_index):
+        start = piece_index * 20
+        end = start + 20
 
-            if i == last_piece:
-                piece_length = self.torrent.total_length - (self.number_of_pieces - 1) * self.torrent.piece_length
-                pieces.append(piece.Piece(i, piece_length, self.torrent.pieces[start:end]))
-            else:
-                pieces.append(piece.Piece(i, self.torrent.piece_length, self.torrent.pieces[start:end]))
+        return piece.Piece(piece_index, self._piece_size(piece_index), self.torrent.pieces[start:end],
+                           self.block_states, self._load_files(piece_index), not self.verifier.use_processes)
 
-        return pieces
+    def _load_file_starts(self):
+        file_starts = []
+        offset = 0
 
-    def _load_files(self):
+        for f in self.torrent.file_names:
+            file_starts.append(offset)
+            offset += f["length"]
+
+        return file_starts
+
+    def _load_files(self, piece_index):
+        """
+            File segments of a piece: the part of each file the piece overlaps
+        """
         files = []
-        piece_offset = 0
-        piece_size_used = 0
+        piece_start = piece_index * self.torrent.piece_length
+        piece_end = piece_start + self._piece_size(piece_index)
+        i = bisect_right(self.file_starts, piece_start) - 1
+
+        while i < len(self.file_starts) and self.file_starts[i] < piece_end:
+            f = self.torrent.file_names[i]
+            start = max(piece_start, self.file_starts[i])
+            end = min(piece_end, self.file_starts[i] + f["length"])
+
+            if start < end:
+                files.append({"length": end - start,
+                              "idPiece": piece_index,
+                              "fileOffset": start - self.file_starts[i],
+                              "pieceOffset": start - piece_start,
+                              "path": f["path"]
+                              })
+            i += 1
 
-        for f in self.torrent.file_names:
-            current_size_file = f["length"]
-            file_offset = 0
-
-            while current_size_file > 0:
-                id_piece = int(piece_offset / self.torrent.piece_length)
-                piece_size = self.pieces[id_piece].piece_size - piece_size_used
-
-                if current_size_file - piece_size < 0:
-                    file = {"length": current_size_file,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    piece_offset += current_size_file
-                    file_offset += current_size_file
-                    piece_size_used += current_size_file
-                    current_size_file = 0
-
-                else:
-                    current_size_file -= piece_size
-                    file = {"length": piece_size,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    piece_offset += piece_size
-                    file_offset += piece_size
-                    piece_size_used = 0
-
-                files.append(file)
         return files
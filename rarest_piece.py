@@ -1,35 +1,184 @@
-import logging
+import numpy as np
+from pubsub import pub
+
+MIN_PEER_ROWS = 8
+ORDER_CHUNK = 1024  # pieces of the rarest-first order looked at per step
 
 
 class RarestPieces(object):
-    def __init__(self, pieces_manager):
+    """
+        Swarm availability and rarest-first piece picker.
+
+        The bitfields of the connected peers are kept as a packed bit matrix, one row of
+        ceil(number_of_pieces / 8) bytes per peer, and availability[i] is the number of connected peers
+        having piece i. Availability, the peers having pieces we need and the rarest-first order are
+        computed with NumPy over whole rows instead of bit by bit in Python.
+
+        order holds every piece sorted by availability, bucket_start[a] being the position of the first
+        piece available from at least a peers, so that a Have moves its piece to the next bucket with one
+        swap. Bitfields and disconnections change many pieces at once and sort the order again with NumPy.
+        A peer's pieces are picked by walking the order a chunk at a time against the peer's unpacked row,
+        kept up to date on its Haves: most picks only look at the first chunk.
 
+        wanted_pieces[row] counts the pieces of the peer we still need (its row AND NOT our bitfield):
+        a peer is worth being interested in while it is not zero.
+    """
+
+    def __init__(self, pieces_manager):
         self.pieces_manager = pieces_manager
-        self.rarest_pieces = []
+        self.number_of_pieces = pieces_manager.number_of_pieces
+        self.row_length = (self.number_of_pieces + 7) // 8
+        self.availability = np.zeros(self.number_of_pieces, dtype=np.int32)
+        self.needed = np.ones(self.number_of_pieces, dtype=bool)
+        self.needed[list(pieces_manager.bitfield.findall('0b1'))] = False
+        self.needed_row = np.packbits(self.needed)
+        self.matrix = np.zeros((MIN_PEER_ROWS, self.row_length), dtype=np.uint8)
+        self.wanted_pieces = np.zeros(MIN_PEER_ROWS, dtype=np.int32)
+        self.rows = {}  # peer -> row of the matrix
+        self.free_rows = list(range(MIN_PEER_ROWS - 1, -1, -1))
+        self.unpacked_rows = {}  # row -> bool array of the peer's pieces, built when first needed
+        self.order = np.arange(self.number_of_pieces, dtype=np.int32)
+        self.position = np.arange(self.number_of_pieces, dtype=np.int32)  # piece -> index in order
+        self.bucket_start = np.full(MIN_PEER_ROWS + 2, self.number_of_pieces, dtype=np.int32)
+        self.bucket_start[0] = 0
+
+        torrent = pieces_manager.torrent
+        pub.subscribe(self.peer_has_piece, torrent.topic('RarestPiece.peerHasPiece'))
+        pub.subscribe(self.peers_bitfield, torrent.topic('RarestPiece.updatePeersBitfield'))
+        pub.subscribe(self.peer_disconnected, torrent.topic('RarestPiece.peerDisconnected'))
+
+    def peer_has_piece(self, peer=None, piece_index=None):
+        if not 0 <= piece_index < self.number_of_pieces:
+            return
+
+        row_index = self._get_row(peer)  # may grow the matrix
+        row = self.matrix[row_index]
+        byte_index, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+
+        if not row[byte_index] & mask:
+            row[byte_index] |= mask
+            self._increment_availability(piece_index)
+            self.wanted_pieces[row_index] += self.needed[piece_index]
+
+            unpacked_row = self.unpacked_rows.get(row_index)
+            if unpacked_row is not None:
+                unpacked_row[piece_index] = True
+
+    def peers_bitfield(self, peer=None, bitfield=None):
+        row_index = self._get_row(peer)
+        row = self.matrix[row_index]
+        self.availability -= self._unpack(row)
+
+        new_row = np.frombuffer(bitfield.tobytes()[:self.row_length], dtype=np.uint8)
+        row[:] = 0
+        row[:len(new_row)] = new_row
+        self._clear_spare_bits(row)
+
+        self.availability += self._unpack(row)
+        self.wanted_pieces[row_index] = self._popcount(row & self.needed_row)
+        self.unpacked_rows.pop(row_index, None)
+        self._sort_pieces()
+
+    def peer_disconnected(self, peer=None):
+        row_index = self.rows.pop(peer, None)
+        if row_index is None:
+            return
+
+        self.availability -= self._unpack(self.matrix[row_index])
+        self.matrix[row_index] = 0
+        self.wanted_pieces[row_index] = 0
+        self.free_rows.append(row_index)
+        self.unpacked_rows.pop(row_index, None)
+        self._sort_pieces()
+
+    def piece_completed(self, piece_index):
+        """
+            Called by the PeersManager before it re-evaluates its interest in the peers having the piece
+        """
+        if self.needed[piece_index]:
+            byte_index, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+            self.needed[piece_index] = False
+            self.needed_row[byte_index] &= ~mask & 0xff
+            self.wanted_pieces[np.flatnonzero(self.matrix[:, byte_index] & mask)] -= 1
+
+    def is_interesting(self, peer):
+        row_index = self.rows.get(peer)
+        return row_index is not None and self.wanted_pieces[row_index] > 0
+
+    def get_peers_having_piece(self, piece_index):
+        peers = list(self.rows)
+        if not peers:
+            return []
+
+        row_indexes = np.fromiter(self.rows.values(), dtype=np.intp, count=len(peers))
+        having = self.matrix[row_indexes, piece_index >> 3] & (0x80 >> (piece_index & 7))
+
+        return [peers[i] for i in np.flatnonzero(having)]
+
+    def get_sorted_pieces(self, peer):
+        """
+            Iterates over the pieces we need that the peer has, rarest first.
+            The swarm must not change while iterating.
+        """
+        row_index = self.rows.get(peer)
+        if row_index is None:
+            return
+
+        unpacked_row = self.unpacked_rows.get(row_index)
+        if unpacked_row is None:
+            unpacked_row = self._unpack(self.matrix[row_index])
+            self.unpacked_rows[row_index] = unpacked_row
+
+        # Pieces nobody has are at the front of the order
+        for start in range(int(self.bucket_start[1]), self.number_of_pieces, ORDER_CHUNK):
+            chunk = self.order[start:start + ORDER_CHUNK]
+            yield from chunk[unpacked_row[chunk] & self.needed[chunk]].tolist()
+
+    def _get_row(self, peer):
+        row_index = self.rows.get(peer)
+
+        if row_index is None:
+            if not self.free_rows:
+                number_of_rows = len(self.matrix)
+                self.matrix = np.vstack((self.matrix, np.zeros_like(self.matrix)))
+                self.wanted_pieces = np.concatenate((self.wanted_pieces, np.zeros_like(self.wanted_pieces)))
+                self.bucket_start = np.concatenate(
+                    (self.bucket_start, np.full(number_of_rows, self.number_of_pieces, dtype=np.int32)))
+                self.free_rows = list(range(2 * number_of_rows - 1, number_of_rows - 1, -1))
+
+            row_index = self.free_rows.pop()
+            self.rows[peer] = row_index
 
-        for piece_number in range(self.pieces_manager.number_of_pieces):
-            self.rarest_pieces.append({"idPiece": piece_number, "numberOfPeers": 0, "peers": []})
+        return row_index
 
-        # pub.subscribe(self.peersBitfield, 'RarestPiece.updatePeersBitfield')
+    def _increment_availability(self, piece_index):
+        """
+            Swaps the piece with the last one of its bucket, which then starts one position earlier
+        """
+        availability = self.availability[piece_index]
+        last = self.bucket_start[availability + 1] - 1
+        other_piece = self.order[last]
+        position = self.position[piece_index]
 
-    def peers_bitfield(self, bitfield=None, peer=None, piece_index=None):
+        self.order[position], self.order[last] = other_piece, piece_index
+        self.position[other_piece], self.position[piece_index] = position, last
+        self.bucket_start[availability + 1] = last
+        self.availability[piece_index] = availability + 1
 
-        if len(self.rarest_pieces) == 0:
-            raise Exception("No more piece")
+    def _sort_pieces(self):
+        self.order = np.argsort(self.availability, kind='stable').astype(np.int32)
+        self.position[self.order] = np.arange(self.number_of_pieces, dtype=np.int32)
+        self.bucket_start = np.searchsorted(self.availability[self.order],
+                                            np.arange(len(self.bucket_start))).astype(np.int32)
 
-        # Piece complete
-        try:
-            if not piece_index == None:
-                self.rarest_pieces.__delitem__(piece_index)
-        except Exception:
-                logging.exception("Failed to remove rarest piece")
+    def _unpack(self, row):
+        return np.unpackbits(row, count=self.number_of_pieces).view(bool)
 
-        # Peer's bitfield updated
-        else:
-            for i in range(len(self.rarest_pieces)):
-                if bitfield[i] == 1 and peer not in self.rarest_pieces[i]["peers"]:
-                    self.rarest_pieces[i]["peers"].append(peer)
-                    self.rarest_pieces[i]["numberOfPeers"] = len(self.rarest_pieces[i]["peers"])
+    @staticmethod
+    def _popcount(row):
+        return int(np.count_nonzero(np.unpackbits(row)))
 
-    def get_sorted_pieces(self):
-        return sorted(self.rarest_pieces, key=lambda x: x['numberOfPeers'])
+    def _clear_spare_bits(self, row):
+        spare_bits = self.row_length * 8 - self.number_of_pieces
+        if spare_bits:
+            row[-1] &= (0xff << spare_bits) & 0xff
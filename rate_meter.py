@@ -0,0 +1,55 @@
+import time
+import threading
+
+RATE_WINDOW = 20  # seconds
+
+
+class RateMeter(object):
+    """
+        Transfer rate over the last `window` seconds, kept as a ring buffer of per second byte counts.
+        Fed from the peer event loop and read from the download thread, hence the lock.
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.buckets = [0] * window
+        self.window_total = 0
+        self.total = 0
+        self.started = time.monotonic()
+        self.current_second = int(self.started)
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self._advance(int(time.monotonic()))
+            self.buckets[self.current_second % self.window] += nbytes
+            self.window_total += nbytes
+            self.total += nbytes
+
+    def rate(self):
+        """
+            Bytes per second
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            self._advance(int(now))
+            window_total = self.window_total
+
+        # The window is the last window - 1 full seconds and the current one so far
+        elapsed = min(self.window - 1 + now % 1, now - self.started)
+
+        return window_total / max(elapsed, 1.0)
+
+    def _advance(self, second):
+        if second - self.current_second >= self.window:
+            self.buckets = [0] * self.window
+            self.window_total = 0
+
+        else:
+            for expired_second in range(self.current_second + 1, second + 1):
+                index = expired_second % self.window
+                self.window_total -= self.buckets[index]
+                self.buckets[index] = 0
+
+        self.current_second = max(second, self.current_second)
@@ -0,0 +1,65 @@
+from block import BLOCK_SIZE
+
+RECEIVE_BUFFER_SIZE = 4 * BLOCK_SIZE
+MIN_FREE_SPACE = 4096
+
+
+class ReceiveBuffer(object):
+    """
+        Preallocated receive arena filled in place by the event loop (sock.recv_into).
+        Unread bytes live in buffer[start:end]; framing is done over memoryviews of that region,
+        and the unread tail is moved back to the front only when the free space runs out.
+    """
+
+    def __init__(self, capacity=RECEIVE_BUFFER_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint=-1):
+        needed = max(sizehint, MIN_FREE_SPACE)
+        if len(self.buffer) - self.end < needed:
+            self._make_room(needed)
+
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def peek(self, length):
+        return self.view[self.start:self.start + length]
+
+    def consume(self, length):
+        self.start += length
+
+        if self.start >= self.end:
+            self.start = 0
+            self.end = 0
+
+    def reserve(self, length):
+        """ Make sure a frame of `length` bytes starting at self.start fits in the arena """
+        if self.start + length > len(self.buffer):
+            self._make_room(length - len(self))
+
+    def _make_room(self, needed):
+        unread = len(self)
+
+        if len(self.buffer) - unread < needed:
+            capacity = len(self.buffer)
+            while capacity - unread < needed:
+                capacity *= 2
+
+            new_buffer = bytearray(capacity)
+            new_buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+
+        elif self.start > 0:
+            self.view[:unread] = self.view[self.start:self.end]
+
+        self.start = 0
+        self.end = unread
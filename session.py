@@ -0,0 +1,108 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from download import Run
+from hypervisor import Hypervisor
+from event_loop import EventLoopThread
+from peers_manager import ConnectionBudget
+from peer_listener import PeerListener, LISTEN_PORT
+from udp_tracker import UdpTrackerClient
+from http_tracker import HttpTrackerClient
+from tracker import MAX_ANNOUNCE_WORKERS
+from verifier import PieceVerifier
+from disk_writer import DiskWriter
+
+MAX_SESSION_PEERS_CONNECTED = 500
+MAX_SESSION_CONNECTING_PEERS = 64  # half-open connections, all torrents together
+STEP_INTERVAL = 0.1
+
+
+class Session(object):
+    """
+        Runs many torrents in one process. They share one event loop thread for every peer connection,
+        the listening port, the tracker clients, the piece verifier and disk writer, and a budget of peer
+        connections on top of the limits of each torrent. Their pubsub topics are keyed by info hash
+        (Torrent.topic) so that blocks and events are only delivered to their own torrent.
+        Bandwidth is capped for all of them by bandwidth.global_limits.
+    """
+
+    def __init__(self, port=LISTEN_PORT, max_peers=MAX_SESSION_PEERS_CONNECTED,
+                 max_connecting=MAX_SESSION_CONNECTING_PEERS):
+        self.event_loop = EventLoopThread()
+        self.event_loop.start()
+        self.budget = ConnectionBudget(max_peers, max_connecting)
+
+        self.peer_listener = PeerListener(self.event_loop.loop, port)
+        self.peer_listener.start()
+
+        self.udp_client = UdpTrackerClient()
+        self.udp_client.start()
+        self.http_client = HttpTrackerClient()
+        self.announce_executor = ThreadPoolExecutor(max_workers=MAX_ANNOUNCE_WORKERS, thread_name_prefix='Tracker')
+
+        self.verifier = PieceVerifier()
+        self.disk_writer = DiskWriter()
+        self.disk_writer.start()
+
+        self.hypervisors = {}  # info_hash -> Hypervisor
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.is_active = True
+
+    def add_torrent(self, torrent_file):
+        """
+            Can be called from any thread, also while the session is running
+            :return: the Hypervisor of the torrent
+        """
+        with self.lock:
+            download = Run(torrent_file, self)
+            hypervisor = Hypervisor(download, self.next_id)
+            self.next_id += 1
+            hypervisor.begin()
+            self.hypervisors[download.torrent.info_hash] = hypervisor
+
+        logging.info("Torrent %d added to the session: %s" % (hypervisor.attributes['id'], torrent_file))
+
+        return hypervisor
+
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            hypervisor = self.hypervisors.pop(info_hash, None)
+
+        if hypervisor is not None:
+            hypervisor.attributes['status'] = 'terminated'
+            hypervisor.download.stop()
+
+    def get_torrent(self, info_hash):
+        return self.hypervisors.get(info_hash)
+
+    def run(self):
+        """
+            Steps every torrent in turn, until stop()
+        """
+        while self.is_active:
+            with self.lock:
+                hypervisors = list(self.hypervisors.values())
+
+            for hypervisor in hypervisors:
+                try:
+                    hypervisor.step()
+                except Exception:
+                    logging.exception("Error in torrent %d" % hypervisor.attributes['id'])
+
+            time.sleep(STEP_INTERVAL)
+
+    def stop(self):
+        self.is_active = False
+
+        for info_hash in list(self.hypervisors):
+            self.remove_torrent(info_hash)
+
+        self.peer_listener.stop()
+        self.event_loop.stop()
+        self.announce_executor.shutdown(wait=False, cancel_futures=True)
+        self.udp_client.stop()
+        self.http_client.close()
+        self.verifier.shutdown()
+        self.disk_writer.stop()
@@ -0,0 +1,155 @@
+import os
+import mmap
+import logging
+from collections import OrderedDict
+
+MAX_OPEN_FILES = 64
+
+
+class Storage(object):
+    """
+        Where verified pieces are kept once written, and read back from to serve uploads.
+        Writes go through the DiskWriter; the piece's buffer is released once it is on disk.
+        Blocks are read from the files with pread.
+    """
+
+    def __init__(self, torrent, disk_writer):
+        self.torrent = torrent
+        self.disk_writer = disk_writer
+        self.read_files = OrderedDict()
+        self.file_users = {}  # path -> transfers in flight from the file, which must not be closed under them
+
+    def get_file(self, path):
+        """
+            Cached file object opened for reading. At most MAX_OPEN_FILES stay open, the least recently
+            used ones not in use are closed first.
+        """
+        file = self.read_files.get(path)
+
+        if file is not None:
+            self.read_files.move_to_end(path)
+            return file
+
+        self._close_unused_files(MAX_OPEN_FILES - 1)
+
+        file = open(path, 'rb')
+        self.read_files[path] = file
+        return file
+
+    def acquire_file(self, path):
+        """
+            get_file() for a transfer that outlives the call, e.g. sendfile: the file stays open until release_file()
+        """
+        file = self.get_file(path)
+        self.file_users[path] = self.file_users.get(path, 0) + 1
+        return file
+
+    def release_file(self, path):
+        users = self.file_users.get(path, 0) - 1
+
+        if users > 0:
+            self.file_users[path] = users
+        else:
+            self.file_users.pop(path, None)
+            self._close_unused_files(MAX_OPEN_FILES)
+
+    def write_piece(self, piece):
+        self.disk_writer.write(piece.get_file_segments(), callback=piece.release_data)
+
+    def read(self, files, block_offset, block_length):
+        return b''.join(os.pread(self.get_file(path).fileno(), length, file_offset)
+                        for path, file_offset, length in self.locate(files, block_offset, block_length))
+
+    def close(self):
+        for file in self.read_files.values():
+            file.close()
+
+        self.read_files.clear()
+        self.file_users.clear()
+
+    def _close_unused_files(self, max_open_files):
+        for path in list(self.read_files):  # least recently used first
+            if len(self.read_files) <= max_open_files:
+                break
+
+            if path not in self.file_users:
+                self.read_files.pop(path).close()
+
+    @staticmethod
+    def locate(files, block_offset, block_length):
+        """
+            (path, file offset, length) of the file segments holding a block of a piece
+            :param files: file segments of the piece, see PiecesManager._load_files
+        """
+        block_end = block_offset + block_length
+
+        for file in files:
+            start = max(block_offset, file["pieceOffset"])
+            end = min(block_end, file["pieceOffset"] + file["length"])
+
+            if start < end:
+                yield file["path"], file["fileOffset"] + start - file["pieceOffset"], end - start
+
+
+class MmapStorage(Storage):
+    """
+        Reads blocks as slices of read-only shared mappings of the torrent files, so verified pieces
+        do not stay in memory: resident memory is whatever the page cache keeps.
+        Files are created at their final (sparse) size so they can be mapped. Each mapping holds a file
+        descriptor, so at most MAX_OPEN_FILES stay mapped, the least recently used ones are unmapped first.
+    """
+
+    def __init__(self, torrent, disk_writer):
+        super(MmapStorage, self).__init__(torrent, disk_writer)
+        self.mappings = OrderedDict()
+
+        for file in torrent.file_names:
+            self._allocate(file["path"], file["length"])
+
+    def read(self, files, block_offset, block_length):
+        segments = [memoryview(self._get_mapping(path))[file_offset:file_offset + length]
+                    for path, file_offset, length in self.locate(files, block_offset, block_length)]
+
+        if len(segments) == 1:
+            return segments[0]
+
+        return b''.join(segments)
+
+    def close(self):
+        super(MmapStorage, self).close()
+
+        for mapping in self.mappings.values():
+            self._unmap(mapping)
+
+        self.mappings.clear()
+
+    def _get_mapping(self, path):
+        mapping = self.mappings.get(path)
+
+        if mapping is not None:
+            self.mappings.move_to_end(path)
+            return mapping
+
+        if len(self.mappings) >= MAX_OPEN_FILES:
+            _, oldest_mapping = self.mappings.popitem(last=False)
+            self._unmap(oldest_mapping)
+
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mappings[path] = mapping
+
+        return mapping
+
+    @staticmethod
+    def _unmap(mapping):
+        try:
+            mapping.close()
+        except BufferError:
+            # A block being sent still points into it, it is unmapped once that block is released
+            logging.debug("Mapping still in use, left to the garbage collector")
+
+    @staticmethod
+    def _allocate(path, length):
+        with open(path, 'ab') as f:
+            if f.tell() < length:
+                f.truncate(length)
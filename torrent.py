@@ -13,6 +13,7 @@ class Torrent(object):
         self.piece_length: int = 0
         self.pieces: int = 0
         self.info_hash: str = ''
+        self.topic_root: str = ''
         self.peer_id: str = ''
         self.announce_list = ''
         self.file_names = []
@@ -27,6 +28,7 @@ class Torrent(object):
         self.pieces = self.torrent_file['info']['pieces']
         raw_info_hash = bencode(self.torrent_file['info'])
         self.info_hash = hashlib.sha1(raw_info_hash).digest()
+        self.topic_root = 'Torrent_' + self.info_hash.hex()
         self.peer_id = self.generate_peer_id()
         self.announce_list = self.get_trakers()
         self.init_files()
@@ -39,6 +41,12 @@ class Torrent(object):
 
         return self
 
+    def topic(self, name):
+        """
+            pubsub topic of this torrent, so that the torrents of a Session don't get each other's events
+        """
+        return '%s.%s' % (self.topic_root, name)
+
     def init_files(self):
         root = self.torrent_file['info']['name']
 
@@ -1,16 +1,21 @@
 import ipaddress
-import struct
-import peer
-from message import UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput
-from peers_manager import PeersManager
-import requests
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from udp_tracker import UdpTrackerClient
+from http_tracker import HttpTrackerClient
+from peer_listener import LISTEN_PORT
 import logging
-from bcoding import bdecode
 import socket
 from urllib.parse import urlparse
 
-MAX_PEERS_TRY_CONNECT = 30
-MAX_PEERS_CONNECTED = 8
+MAX_ANNOUNCE_WORKERS = 32
+DEFAULT_ANNOUNCE_INTERVAL = 30 * 60  # when the tracker does not give one
+MIN_ANNOUNCE_INTERVAL = 60  # earliest early re-announce when we need peers, unless the tracker gives one
+ANNOUNCE_RETRY_DELAY = 15  # first retry after a failure, doubled on each failure
+MAX_ANNOUNCE_RETRY_DELAY = 30 * 60
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
 
 
 class SockAddr:
@@ -23,155 +28,184 @@ class SockAddr:
         return "%s:%d" % (self.ip, self.port)
 
 
-class Tracker(object):
-    def __init__(self, torrent):
-        self.torrent = torrent
-        self.threads_list = []
-        self.connected_peers = {}
-        self.dict_sock_addr = {}
-
-    def get_peers_from_trackers(self):
-        for i, tracker in enumerate(self.torrent.announce_list):
-            if len(self.dict_sock_addr) >= MAX_PEERS_TRY_CONNECT:
-                break
-
-            tracker_url = tracker[0]
+class TrackerState(object):
+    """
+        Announce schedule of one tracker: next announce time, intervals given by the tracker, failures
+        and the event to send with the next announce.
+    """
 
-            if str.startswith(tracker_url, "http"):
-                try:
-                    self.http_scraper(self.torrent, tracker_url)
-                except Exception as e:
-                    logging.error("HTTP scraping failed: %s " % e.__str__())
+    def __init__(self, url):
+        self.url = url
+        self.interval = DEFAULT_ANNOUNCE_INTERVAL
+        self.min_interval = MIN_ANNOUNCE_INTERVAL
+        self.last_announce = 0.0
+        self.next_announce = 0.0
+        self.failures = 0
+        self.is_announcing = False
+        self.event = 'started'
 
-            elif str.startswith(tracker_url, "udp"):
-                try:
-                    self.udp_scrapper(tracker_url)
-                except Exception as e:
-                    logging.error("UDP scraping failed: %s " % e.__str__())
+    def is_due(self, now, need_peers=False):
+        if self.is_announcing:
+            return False
 
-            else:
-                logging.error("unknown scheme for: %s " % tracker_url)
-
-        self.try_peer_connect()
+        if now >= self.next_announce:
+            return True
 
-        return self.connected_peers
+        # Early re-announce when we run out of peers, no more often than the tracker allows
+        return need_peers and self.failures == 0 and now - self.last_announce >= self.min_interval
 
-    def try_peer_connect(self):
-        logging.info("Trying to connect to %d peer(s)" % len(self.dict_sock_addr))
+    def announced(self, now, interval=None, min_interval=None):
+        self.failures = 0
+        self.event = ''
+        self.interval = interval or DEFAULT_ANNOUNCE_INTERVAL
+        self.min_interval = min_interval or min(MIN_ANNOUNCE_INTERVAL, self.interval)
+        self.last_announce = now
+        self.next_announce = now + self.interval
 
-        for _, sock_addr in self.dict_sock_addr.items():
-            if len(self.connected_peers) >= MAX_PEERS_CONNECTED:
-                break
+    def failed(self, now):
+        self.failures += 1
+        delay = min(MAX_ANNOUNCE_RETRY_DELAY, ANNOUNCE_RETRY_DELAY * 2 ** (self.failures - 1))
+        self.next_announce = now + delay * random.uniform(0.75, 1.25)  # jitter: dead trackers are not retried in sync
 
-            new_peer = peer.Peer(int(self.torrent.number_of_pieces), sock_addr.ip, sock_addr.port)
-            if not new_peer.connect():
-                continue
 
-            print('Connected to %d/%d peers' % (len(self.connected_peers), MAX_PEERS_CONNECTED))
+class Tracker(object):
+    def __init__(self, torrent, udp_client=None, http_client=None, executor=None):
+        self.torrent = torrent
+        self.http_client = http_client or HttpTrackerClient()
+        self.own_http_client = http_client is None
+        self.udp_client = udp_client
+        self.own_udp_client = udp_client is None
+
+        if self.udp_client is None:
+            self.udp_client = UdpTrackerClient()
+            self.udp_client.start()
+
+        self.lock = threading.Lock()
+        self.trackers = [TrackerState(url)
+                         for url in dict.fromkeys(url for tier in torrent.announce_list for url in tier)]
+        self.uploaded = 0
+        self.downloaded = 0
+        self.left = torrent.total_length
+        self.executor = executor or ThreadPoolExecutor(max_workers=MAX_ANNOUNCE_WORKERS, thread_name_prefix='Tracker')
+        self.own_executor = executor is None
+
+    def update_transfer(self, uploaded, downloaded, left):
+        """
+            Counters reported with the next announces. The trackers are told at once when the download completes.
+        """
+        with self.lock:
+            if left == 0 and self.left > 0:
+                for state in self.trackers:
+                    if state.event != 'started':
+                        state.event = 'completed'
+                        state.next_announce = 0.0
+
+            self.uploaded, self.downloaded, self.left = uploaded, downloaded, left
+
+    def get_peers_from_trackers(self, on_peers=None, need_peers=False):
+        """
+            Announces, without waiting for them, to every tracker of the announce list that is due: at
+            the start, then on the interval given by each tracker, or sooner when need_peers is set.
+            Failed trackers are retried with a jittered exponential backoff.
+            As each tracker answers, its addresses are passed to on_peers(sock_addrs), from a worker thread.
+            Every answer is passed on, so that peers which disconnected or failed to connect can be tried
+            again: on_peers skips the ones it already has.
+            :return: the futures of the announces
+        """
+        now = time.time()
+        due_trackers = []
+
+        with self.lock:
+            for state in self.trackers:
+                if state.is_due(now, need_peers):
+                    state.is_announcing = True
+                    due_trackers.append(state)
+
+        return [self.executor.submit(self._announce, state, on_peers) for state in due_trackers]
+
+    def _announce(self, state, on_peers):
+        sock_addrs = []
+
+        with self.lock:
+            event, uploaded, downloaded, left = state.event, self.uploaded, self.downloaded, self.left
 
-            self.connected_peers[new_peer.__hash__()] = new_peer
+        try:
+            if str.startswith(state.url, "http"):
+                sock_addrs, interval, min_interval = self.http_scraper(self.torrent, state.url, event,
+                                                                      uploaded, downloaded, left)
 
-    def http_scraper(self, torrent, tracker):
-        params = {
-            'info_hash': torrent.info_hash,
-            'peer_id': torrent.peer_id,
-            'uploaded': 0,
-            'downloaded': 0,
-            'port': 6881,
-            'left': torrent.total_length,
-            'event': 'started'
-        }
+            elif str.startswith(state.url, "udp"):
+                sock_addrs, interval, min_interval = self.udp_scrapper(state.url, event, uploaded, downloaded, left)
 
-        try:
-            answer_tracker = requests.get(tracker, params=params, timeout=5)
-            list_peers = bdecode(answer_tracker.content)
-            offset=0
-            if not type(list_peers['peers']) == list:
-                '''
-                    - Handles bytes form of list of peers
-                    - IP address in bytes form:
-                        - Size of each IP: 6 bytes
-                        - The first 4 bytes are for IP address
-                        - Next 2 bytes are for port number
-                    - To unpack initial 4 bytes !i (big-endian, 4 bytes) is used.
-                    - To unpack next 2 byets !H(big-endian, 2 bytes) is used.
-                '''
-                for _ in range(len(list_peers['peers'])//6):
-                    ip = struct.unpack_from("!i", list_peers['peers'], offset)[0]
-                    ip = socket.inet_ntoa(struct.pack("!i", ip))
-                    offset += 4
-                    port = struct.unpack_from("!H",list_peers['peers'], offset)[0]
-                    offset += 2
-                    s = SockAddr(ip,port)
-                    self.dict_sock_addr[s.__hash__()] = s
             else:
-                for p in list_peers['peers']:
-                    s = SockAddr(p['ip'], p['port'])
-                    self.dict_sock_addr[s.__hash__()] = s
+                logging.error("unknown scheme for: %s " % state.url)
+                interval, min_interval = None, None
 
-        except Exception as e:
-            logging.exception("HTTP scraping failed: %s" % e.__str__())
+            with self.lock:
+                state.announced(time.time(), interval, min_interval)
 
-    def udp_scrapper(self, announce):
-        torrent = self.torrent
-        parsed = urlparse(announce)
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(4)
-        ip, port = socket.gethostbyname(parsed.hostname), parsed.port
+        except Exception as e:
+            logging.error("Scraping %s failed: %s " % (state.url, e.__str__()))
 
-        if ipaddress.ip_address(ip).is_private:
-            return
+            with self.lock:
+                state.failed(time.time())
 
-        tracker_connection_input = UdpTrackerConnection()
-        response = self.send_message((ip, port), sock, tracker_connection_input)
+        finally:
+            state.is_announcing = False
 
-        if not response:
-            raise Exception("No response for UdpTrackerConnection")
+        logging.info("Got %d peer address(es) from %s" % (len(sock_addrs), state.url))
 
-        tracker_connection_output = UdpTrackerConnection()
-        tracker_connection_output.from_bytes(response)
+        if sock_addrs and on_peers:
+            on_peers(sock_addrs)
 
-        tracker_announce_input = UdpTrackerAnnounce(torrent.info_hash, tracker_connection_output.conn_id,
-                                                    torrent.peer_id)
-        response = self.send_message((ip, port), sock, tracker_announce_input)
+        return sock_addrs
 
-        if not response:
-            raise Exception("No response for UdpTrackerAnnounce")
+    def stop(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
-        tracker_announce_output = UdpTrackerAnnounceOutput()
-        tracker_announce_output.from_bytes(response)
+        if self.own_http_client:
+            self.http_client.close()
 
-        for ip, port in tracker_announce_output.list_sock_addr:
-            sock_addr = SockAddr(ip, port)
+        if self.own_udp_client:
+            self.udp_client.stop()
 
-            if sock_addr.__hash__() not in self.dict_sock_addr:
-                self.dict_sock_addr[sock_addr.__hash__()] = sock_addr
+    def http_scraper(self, torrent, tracker, event='started', uploaded=0, downloaded=0, left=None):
+        """
+            :return: (peer addresses, interval, min interval)
+        """
+        params = {
+            'info_hash': torrent.info_hash,
+            'peer_id': torrent.peer_id,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'port': LISTEN_PORT,
+            'left': torrent.total_length if left is None else left,
+        }
 
-        print("Got %d peers" % len(self.dict_sock_addr))
+        if event:
+            params['event'] = event
 
-    def send_message(self, conn, sock, tracker_message):
-        message = tracker_message.to_bytes()
-        trans_id = tracker_message.trans_id
-        action = tracker_message.action
-        size = len(message)
+        decoded_answer, sock_addrs = self.http_client.announce(tracker, params)
 
-        sock.sendto(message, conn)
+        return ([SockAddr(ip, port) for ip, port in sock_addrs],
+                decoded_answer.get('interval'), decoded_answer.get('min interval'))
 
-        try:
-            response = PeersManager._read_from_socket(sock)
-        except socket.timeout as e:
-            logging.debug("Timeout : %s" % e)
-            return
-        except Exception as e:
-            logging.exception("Unexpected error when sending message : %s" % e.__str__())
-            return
+    def udp_scrapper(self, announce, event='started', uploaded=0, downloaded=0, left=None):
+        """
+            :return: (peer addresses, interval, min interval)
+        """
+        torrent = self.torrent
+        parsed = urlparse(announce)
+        ip, port = socket.gethostbyname(parsed.hostname), parsed.port
 
-        if len(response) < size:
-            logging.debug("Did not get full message.")
+        if ipaddress.ip_address(ip).is_private:
+            return [], None, None
 
-        if action != response[0:4] or trans_id != response[4:8]:
-            logging.debug("Transaction or Action ID did not match")
+        tracker_announce_output = self.udp_client.announce((ip, port), torrent.info_hash, torrent.peer_id,
+                                                           downloaded,
+                                                           torrent.total_length if left is None else left,
+                                                           uploaded, UDP_EVENTS[event], LISTEN_PORT)
 
-        return response
+        return ([SockAddr(ip, port) for ip, port in tracker_announce_output.list_sock_addr],
+                tracker_announce_output.interval, None)
@@ -0,0 +1,194 @@
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError
+from struct import unpack
+from threading import Thread
+
+from message import UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput, UdpTrackerScrape, \
+    UdpTrackerScrapeOutput
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+CONNECTION_ID_LIFETIME = 60
+RETRANSMIT_TIMEOUT = 15  # BEP 15: the n-th attempt waits 15 * 2 ** n seconds
+MAX_RETRANSMITS = 3  # BEP 15 goes up to n = 8, more than an hour for a dead tracker
+MAX_SCRAPE_INFO_HASHES = 74  # what fits in one scrape packet
+UNRESPONSIVE_TRACKER_DELAY = 1800  # seconds a tracker that never answered is skipped for
+
+
+class UdpTrackerError(Exception):
+    pass
+
+
+class UdpTrackerClient(Thread):
+    """
+        BEP 15 client sharing one UDP socket between all the UDP trackers.
+
+        Requests are sent from the callers' threads, which block until the answer; this thread receives
+        every answer and hands it to the transaction waiting for it (same transaction id and tracker
+        address, anything else is dropped). Connection ids are cached per tracker for their 60s validity,
+        so an announce is a single round trip most of the time. Unanswered requests are retransmitted
+        with the spec's exponential timeout.
+
+        The client is shared by all the torrents of a Session, and each exchange blocks a caller's thread
+        for up to minutes on a dead tracker. So once all the retransmits of a request to a tracker have
+        failed, new requests to it fail at once for UNRESPONSIVE_TRACKER_DELAY or until it answers another
+        one: a dead tracker is only waited for once, not once per torrent. Requests still being retransmitted
+        keep going, a single lost datagram doesn't fail the other torrents' announces.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='UdpTrackerClient', daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        self.sock.settimeout(1)
+        self.lock = threading.Lock()
+        self.transactions = {}  # transaction id -> (tracker address, Future)
+        self.connection_ids = {}  # tracker address -> (connection id, expiry time)
+        self.unresponsive_trackers = {}  # tracker address -> time before which requests to it fail at once
+        self.is_active = True
+
+    def announce(self, address, info_hash, peer_id, downloaded=0, left=0, uploaded=0, event=0, port=6881):
+        """
+            :return: UdpTrackerAnnounceOutput
+        """
+        response = self._exchange(address, ACTION_ANNOUNCE,
+                                  lambda conn_id: UdpTrackerAnnounce(info_hash, conn_id, peer_id, downloaded, left,
+                                                                     uploaded, event, port))
+        announce_output = UdpTrackerAnnounceOutput()
+        announce_output.from_bytes(response)
+
+        return announce_output
+
+    def scrape(self, address, info_hashes):
+        """
+            Scrapes several torrents at once, MAX_SCRAPE_INFO_HASHES per request.
+            :return: dict info_hash -> (seeders, completed, leechers)
+        """
+        info_hashes = list(info_hashes)
+        stats = {}
+
+        for start in range(0, len(info_hashes), MAX_SCRAPE_INFO_HASHES):
+            batch = info_hashes[start:start + MAX_SCRAPE_INFO_HASHES]
+            response = self._exchange(address, ACTION_SCRAPE, lambda conn_id: UdpTrackerScrape(conn_id, batch))
+
+            scrape_output = UdpTrackerScrapeOutput()
+            scrape_output.from_bytes(response)
+            stats.update(zip(batch, scrape_output.stats))
+
+        return stats
+
+    def stop(self):
+        self.is_active = False
+        self.join()
+        self.sock.close()
+
+    def run(self):
+        while self.is_active:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                logging.exception("UDP tracker socket error")
+                continue
+
+            if len(data) < 8:
+                continue
+
+            with self.lock:
+                transaction = self.transactions.get(data[4:8])
+
+            if transaction is None or transaction[0] != address:
+                logging.debug("Dropping unexpected UDP tracker answer from %s:%d" % address)
+                continue
+
+            if not transaction[1].done():
+                transaction[1].set_result(data)
+
+    def _get_connection_id(self, address):
+        with self.lock:
+            connection_id, expiry = self.connection_ids.get(address, (None, 0.0))
+
+        if time.time() < expiry:
+            return connection_id
+
+        response = self._exchange(address, ACTION_CONNECT, lambda _: UdpTrackerConnection(), needs_connection=False)
+        connection_output = UdpTrackerConnection()
+        connection_output.from_bytes(response[:16])
+
+        with self.lock:
+            self.connection_ids[address] = (connection_output.conn_id, time.time() + CONNECTION_ID_LIFETIME)
+
+        return connection_output.conn_id
+
+    def _exchange(self, address, action, build_message, needs_connection=True):
+        """
+            Sends the message built by build_message(connection_id) and waits for its answer, retransmitting
+            it on timeout. It is rebuilt with a new connection id if the cached one expires in between.
+        """
+        transaction_id, connection_id, tracker_message, future = None, None, None, None
+
+        with self.lock:
+            if time.time() < self.unresponsive_trackers.get(address, 0.0):
+                raise UdpTrackerError("UDP tracker %s:%d is not answering" % address)
+
+        try:
+            for attempt in range(MAX_RETRANSMITS + 1):
+                current_connection_id = self._get_connection_id(address) if needs_connection else None
+
+                if tracker_message is None or current_connection_id != connection_id:
+                    self._end_transaction(transaction_id)
+                    connection_id = current_connection_id
+                    tracker_message = build_message(connection_id)
+                    transaction_id = tracker_message.trans_id
+                    future = Future()
+
+                    with self.lock:
+                        self.transactions[transaction_id] = (address, future)
+
+                self.sock.sendto(tracker_message.to_bytes(), address)
+
+                try:
+                    response = future.result(timeout=RETRANSMIT_TIMEOUT * 2 ** attempt)
+                except TimeoutError:
+                    logging.debug("No answer from UDP tracker %s:%d, attempt %d" % (address + (attempt,)))
+                    continue
+
+                with self.lock:
+                    self.unresponsive_trackers.pop(address, None)
+
+                return self._check_response(address, action, response)
+
+        finally:
+            self._end_transaction(transaction_id)
+
+        self._set_unresponsive(address, UNRESPONSIVE_TRACKER_DELAY)
+        raise UdpTrackerError("UDP tracker %s:%d did not answer" % address)
+
+    def _set_unresponsive(self, address, delay):
+        with self.lock:
+            self.unresponsive_trackers[address] = time.time() + delay
+
+    def _end_transaction(self, transaction_id):
+        if transaction_id is not None:
+            with self.lock:
+                self.transactions.pop(transaction_id, None)
+
+    def _check_response(self, address, action, response):
+        response_action, = unpack('>I', response[:4])
+
+        if response_action == ACTION_ERROR:
+            with self.lock:
+                self.connection_ids.pop(address, None)  # the error may be about the connection id
+            raise UdpTrackerError("UDP tracker error: %s" % bytes(response[8:]).decode('utf-8', 'replace'))
+
+        if response_action != action:
+            raise UdpTrackerError("Wrong action %d from UDP tracker, expected %d" % (response_action, action))
+
+        return response
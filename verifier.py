@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def finish_digest(hasher, remaining_data):
+    hasher.update(remaining_data)
+    return hasher.digest()
+
+
+def digest(data):
+    return hashlib.sha1(data).digest()
+
+
+class PieceVerifier(object):
+    """
+        Hashes completed pieces off the network thread.
+
+        With threads (default), the pool keeps a running SHA-1 of each piece as its blocks arrive, one update
+        at a time per piece, and finishes it once the piece is full; hashlib releases the GIL on large buffers
+        so pieces hash in parallel and the event loop does not hash at all.
+        With processes, the whole piece is copied to a worker process and hashed there.
+        The result is posted back to the event loop that submitted the piece.
+    """
+
+    def __init__(self, max_workers=None, use_processes=False):
+        self.use_processes = use_processes
+        max_workers = max_workers or os.cpu_count() or 1
+
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='PieceVerifier')
+
+        self.waiting_pieces = {}  # piece -> callback, verified once its running hash update is done
+
+    def update(self, piece):
+        """
+            Hashes the new contiguous blocks of a piece on the pool. Without an event loop, the whole piece
+            is hashed by verify() instead.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        job = piece.get_hash_update()
+        if job is None:
+            return
+
+        future = loop.run_in_executor(self.executor, job[0], *job[1])
+        future.add_done_callback(lambda f: self._updated(piece, f))
+
+    def _updated(self, piece, future):
+        failed = future.cancelled() or future.exception() is not None
+        if failed and not future.cancelled():
+            logging.error("Failed to hash blocks of piece %d : %s" % (piece.piece_index, future.exception()))
+
+        piece.hash_update_done(failed)
+
+        callback = self.waiting_pieces.pop(piece, None)
+        if callback is not None:
+            self.verify(piece, callback)
+        else:
+            self.update(piece)  # blocks received in the meantime
+
+    def verify(self, piece, callback):
+        """
+            Calls callback(piece, digest) from the calling thread's event loop once the piece is hashed.
+        """
+        if piece.is_hashing:
+            self.waiting_pieces[piece] = callback
+            return
+
+        if self.use_processes:
+            job, args = digest, (bytes(piece.raw_data),)
+        else:
+            job, args = piece.get_hash_job()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            callback(piece, job(*args))
+            return
+
+        future = loop.run_in_executor(self.executor, job, *args)
+        future.add_done_callback(lambda f: self._done(piece, callback, f))
+
+    @staticmethod
+    def _done(piece, callback, future):
+        try:
+            piece_digest = future.result()
+        except Exception:
+            logging.exception("Failed to hash piece %d" % piece.piece_index)
+            piece_digest = None
+
+        callback(piece, piece_digest)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)